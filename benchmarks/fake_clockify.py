@@ -0,0 +1,249 @@
+"""
+Local stand-in for the parts of the Clockify API that ClockifyTocker
+uses, with configurable latency and error rate, so benchmarks do not
+depend on (or hammer) the real service. It also posts sample webhook
+payloads, as Clockify would, to any subscribed receiver.
+"""
+
+import json
+import time
+import uuid
+import queue
+import random
+import datetime
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+USER_ID = "bench-user"
+
+
+class FakeClockify:
+    """
+    Runs the stand-in on a background thread. `latency` (seconds)
+    is added to every request, and `error_rate` of them fail with
+    a 503.
+    """
+
+    def __init__(self, workspace_id="bench-workspace", projects=50, latency=0.0, error_rate=0.0):
+        self.workspace_id = workspace_id
+        self.latency = latency
+        self.error_rate = error_rate
+        self.projects = [
+            {
+                "id": f"p{i}",
+                "name": f"Project {i}",
+                "color": f"#{random.randrange(0x1000000):06X}",
+                "archived": False,
+                "memberships": [{"membershipStatus": "ACTIVE"}],
+            }
+            for i in range(projects)
+        ]
+        self.active = None
+        self.history = []
+        self.requests = []
+        self.subscribers = []
+        self._webhooks = queue.Queue()
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake._handle(self, "GET")
+
+            def do_POST(self):
+                fake._handle(self, "POST")
+
+            def do_PATCH(self):
+                fake._handle(self, "PATCH")
+
+            def do_DELETE(self):
+                fake._handle(self, "DELETE")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        threading.Thread(target=self._send_webhooks, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._webhooks.put(None)
+        self._server.shutdown()
+        self._server.server_close()
+
+    def subscribe(self, url, token):
+        """
+        Post webhooks to `url`, signed with `token`, from now on.
+        """
+
+        self.subscribers.append((url, token))
+
+    def _emit(self, event, payload):
+        if self.subscribers:
+            self._webhooks.put((event, json.dumps(payload).encode("utf-8")))
+
+    def _send_webhooks(self):
+        # One at a time, so receivers see events in order
+        while True:
+            item = self._webhooks.get()
+            if item is None:
+                return
+            event, body = item
+            for url, token in self.subscribers:
+                request = urllib.request.Request(
+                    url,
+                    data=body,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Clockify-Webhook-Event-Type": event,
+                        "Clockify-Signature": token,
+                    },
+                )
+                try:
+                    urllib.request.urlopen(request, timeout=5).close()
+                except OSError:
+                    pass
+
+    def _entry_payload(self, entry):
+        project = next((p for p in self.projects if p["id"] == entry["projectId"]), None)
+        return dict(entry, userId=USER_ID, workspaceId=self.workspace_id, project=project)
+
+    def start_elsewhere(self, project=0):
+        """
+        Start a timer as the browser plugin or phone app would,
+        without going through the API.
+        """
+
+        now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self._lock:
+            self._stop_active(now)
+            self.active = {
+                "id": uuid.uuid4().hex,
+                "projectId": self.projects[project]["id"],
+                "description": "",
+                "timeInterval": {"start": now, "end": None},
+            }
+            payload = self._entry_payload(self.active)
+        self._emit("NEW_TIMER_STARTED", payload)
+        return payload
+
+    def _stop_active(self, end):
+        # As Clockify does, when a timer is stopped or another started
+        stopped, self.active = self.active, None
+        if stopped:
+            stopped["timeInterval"]["end"] = end
+            self.history.append(stopped)
+        return stopped
+
+    def stop_elsewhere(self):
+        with self._lock:
+            stopped = self._stop_active(
+                datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+            )
+        if stopped:
+            self._emit("TIMER_STOPPED", self._entry_payload(stopped))
+        return stopped
+
+    def add_project(self, name, color="#03A9F4"):
+        project = {
+            "id": uuid.uuid4().hex[:24],
+            "name": name,
+            "color": color,
+            "archived": False,
+            "memberships": [{"membershipStatus": "ACTIVE"}],
+        }
+        with self._lock:
+            self.projects.append(project)
+        self._emit("NEW_PROJECT", dict(project, workspaceId=self.workspace_id))
+        return project
+
+    def _reply(self, handler, status, body=None):
+        payload = json.dumps(body if body is not None else {}).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+    def _handle(self, handler, method):
+        url = urlparse(handler.path)
+        path = url.path[len("/api/v1") :].rstrip("/")
+        query = parse_qs(url.query)
+        body = None
+        if "Content-Length" in handler.headers:
+            body = json.loads(handler.rfile.read(int(handler.headers["Content-Length"])) or b"null")
+
+        with self._lock:
+            self.requests.append((method, path))
+
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error_rate and random.random() < self.error_rate:
+            return self._reply(handler, 503, {"message": "Injected failure"})
+
+        workspace = f"/workspaces/{self.workspace_id}"
+        entries = f"{workspace}/user/{USER_ID}/time-entries"
+        if method == "GET" and path == "/user":
+            return self._reply(handler, 200, {"id": USER_ID, "name": "Bench"})
+        if method == "GET" and path == f"{workspace}/projects":
+            page = int(query.get("page", ["1"])[0])
+            size = int(query.get("page-size", ["50"])[0])
+            return self._reply(handler, 200, self.projects[(page - 1) * size : page * size])
+        if method == "GET" and path == entries:
+            if "in-progress" in query:
+                return self._reply(handler, 200, [self.active] if self.active else [])
+            since = query.get("start", [""])[0]
+            page = int(query.get("page", ["1"])[0])
+            size = int(query.get("page-size", ["50"])[0])
+            with self._lock:
+                found = [
+                    entry
+                    for entry in self.history + ([self.active] if self.active else [])
+                    if entry["timeInterval"]["start"] >= since
+                ]
+            return self._reply(handler, 200, found[(page - 1) * size : page * size])
+        if method == "POST" and path == f"{workspace}/time-entries":
+            with self._lock:
+                self._stop_active(body.get("start"))
+                self.active = {
+                    "id": uuid.uuid4().hex,
+                    "projectId": body.get("projectId"),
+                    "description": body.get("description"),
+                    "timeInterval": {"start": body.get("start"), "end": None},
+                }
+            self._emit("NEW_TIMER_STARTED", self._entry_payload(self.active))
+            return self._reply(handler, 201, self.active)
+        if method == "PATCH" and path == entries:
+            with self._lock:
+                stopped = self._stop_active(body.get("end"))
+            if not stopped:
+                # As Clockify does, with no timer running
+                return self._reply(handler, 404, {"message": "No running time entry"})
+            self._emit("TIMER_STOPPED", self._entry_payload(stopped))
+            return self._reply(handler, 200, stopped)
+        if method == "DELETE" and path.startswith(f"{workspace}/time-entries/"):
+            with self._lock:
+                if self.active and path.endswith(f"/{self.active['id']}"):
+                    deleted, self.active = self.active, None
+                    self._emit("TIME_ENTRY_DELETED", self._entry_payload(deleted))
+                self.history = [e for e in self.history if not path.endswith(f"/{e['id']}")]
+            return self._reply(handler, 200)
+        return self._reply(handler, 404, {"message": f"No fake for {method} {path}"})
+
+    def reset(self):
+        with self._lock:
+            self.active = None
+            self.history = []
+            self.requests = []
@@ -0,0 +1,116 @@
+"""
+Fake StreamDeck device, implementing the parts of the StreamDeck
+library's device API that streamdeck_ui drives, so the real display
+pipeline can run without hardware. Every key image pushed is
+recorded, with the time it arrived.
+"""
+
+import time
+import threading
+
+LAYOUTS = {
+    6: (2, 3, "Stream Deck Mini", 80),
+    15: (3, 5, "Stream Deck Original", 72),
+    32: (4, 8, "Stream Deck XL", 96),
+}
+
+
+class FakeStreamDeck:
+    def __init__(self, serial, keys=15):
+        self.serial = serial
+        self.rows, self.cols, self.type, self.pixels = LAYOUTS[keys]
+        self._open = False
+        self._callback = None
+        self.brightness = None
+        self.images = {}
+        self.pushes = []
+        self._pushed = threading.Condition()
+
+    def id(self):
+        return f"fake:{self.serial}"
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self._open = False
+
+    def is_open(self):
+        return self._open
+
+    def connected(self):
+        return True
+
+    def reset(self):
+        self.images = {}
+
+    def deck_type(self):
+        return self.type
+
+    def get_serial_number(self):
+        return self.serial
+
+    def get_firmware_version(self):
+        return "fake"
+
+    def is_visual(self):
+        return True
+
+    def key_count(self):
+        return self.rows * self.cols
+
+    def key_layout(self):
+        return (self.rows, self.cols)
+
+    def key_image_format(self):
+        return {
+            "size": (self.pixels, self.pixels),
+            "format": "JPEG",
+            "flip": (True, True),
+            "rotation": 0,
+        }
+
+    def set_brightness(self, percent):
+        self.brightness = percent
+
+    def set_key_callback(self, callback):
+        self._callback = callback
+
+    def set_key_image(self, key, image):
+        with self._pushed:
+            self.images[key] = image
+            self.pushes.append((time.perf_counter(), key))
+            self._pushed.notify_all()
+
+    def press(self, key):
+        """
+        Simulate pressing and releasing a key.
+        """
+
+        self._callback(self, key, True)
+        self._callback(self, key, False)
+
+    def wait_for_push(self, key, since, timeout=5):
+        """
+        Wait for an image to be pushed to `key` after `since`
+        (a perf_counter reading), returning when it arrived.
+        """
+
+        deadline = time.perf_counter() + timeout
+        with self._pushed:
+            while True:
+                for at, pushed in reversed(self.pushes):
+                    if at < since:
+                        break
+                    if pushed == key:
+                        return at
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    return None
+                self._pushed.wait(remaining)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
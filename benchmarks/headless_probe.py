@@ -0,0 +1,71 @@
+"""
+Runs the headless application against a fake deck for a while and
+prints its footprint as JSON. The headless_footprint benchmark runs
+this in a process of its own, so nothing else is counted.
+
+    python -m benchmarks.headless_probe [seconds]
+"""
+
+import sys
+import json
+import time
+import resource
+import threading
+
+# Exit status for missing dependencies, reported as skipped
+SKIPPED = 3
+SETTLE = 2.0
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    try:
+        from tickertock.tickertock import Tickertock
+        from tickertock.headless import HeadlessApplication
+    except (ImportError, OSError) as e:
+        print(e, file=sys.stderr)
+        return SKIPPED
+
+    from .fake_streamdeck import FakeStreamDeck
+
+    deck = FakeStreamDeck("HEADLESS")
+
+    class Devices:
+        def enumerate(self):
+            return [deck]
+
+    tickertock = Tickertock("clockify")
+    tickertock.initialize(with_images=True)
+    application = HeadlessApplication(tickertock, Devices())
+
+    started = {}
+
+    def settled():
+        started["cpu"] = time.process_time()
+        started["wall"] = time.monotonic()
+        started["pushes"] = len(deck.pushes)
+        started["threads"] = threading.active_count()
+
+    threading.Timer(SETTLE, application.loop.invoke, (settled,)).start()
+    threading.Timer(SETTLE + seconds, application.loop.stop).start()
+    application.run()
+
+    idle = time.monotonic() - started["wall"]
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print(
+        json.dumps(
+            {
+                "max_rss_mb": usage.ru_maxrss / 1024,
+                "threads": started["threads"],
+                "idle_seconds": idle,
+                "idle_cpu_percent": (time.process_time() - started["cpu"]) / idle * 100,
+                "idle_key_pushes": len(deck.pushes) - started["pushes"],
+                "qt_loaded": any(name.startswith("PySide6") for name in sys.modules),
+            }
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
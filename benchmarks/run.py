@@ -0,0 +1,504 @@
+"""
+Benchmarks for tickertock's hot paths, run against a local Clockify
+stand-in and fake StreamDecks. From the repository root:
+
+    python -m benchmarks.run --output new.json --compare old.json
+
+Benchmarks whose dependencies (cairo, PySide6, streamdeck_ui...) are
+not installed are skipped and listed as such in the results.
+"""
+
+import os
+import sys
+import tempfile
+
+# Keep well away from the real config, cache and journal. This has
+# to happen before tickertock.config is imported.
+_HOME = tempfile.mkdtemp(prefix="tickertock-bench-")
+for _var in ("XDG_CONFIG_HOME", "XDG_CACHE_HOME", "XDG_DATA_HOME", "XDG_RUNTIME_DIR"):
+    os.environ[_var] = os.path.join(_HOME, _var.lower())
+    os.makedirs(os.environ[_var], mode=0o700, exist_ok=True)
+
+import json
+import time
+import types
+import argparse
+import platform
+import datetime
+import statistics
+import subprocess
+
+from tickertock import __version__
+from tickertock.config import CONFIG_DIR
+
+from .fake_clockify import FakeClockify
+from .fake_streamdeck import FakeStreamDeck
+
+BENCHMARKS = {}
+
+
+class Skipped(Exception):
+    pass
+
+
+def benchmark(name):
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+
+    return register
+
+
+def summarize(timings, **extra):
+    timings = sorted(timings)
+    summary = {
+        "n": len(timings),
+        "mean_ms": statistics.mean(timings) * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        "min_ms": timings[0] * 1000,
+        "max_ms": timings[-1] * 1000,
+    }
+    summary.update(extra)
+    return summary
+
+
+def measure(function, repeat, warmup=1):
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def write_config(fake):
+    """
+    Point a fresh tickertock config at the stand-in.
+    """
+
+    CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    (CONFIG_DIR / "assets").mkdir(exist_ok=True)
+    (CONFIG_DIR / "config.toml").write_text(
+        "syncRate = 30000\n\n"
+        "[clockify]\n"
+        'apiKey = "bench"\n'
+        f'workspaceId = "{fake.workspace_id}"\n'
+        f'apiUrl = "{fake.url}"\n'
+    )
+    projects = "\n".join(
+        f'"{p["name"]}" = {{"name" = "{p["name"]}", "colour" = "{p["color"][1:]}"}}'
+        for p in fake.projects
+    )
+    entries = ",\n".join(f'  "{p["name"]}"' for p in fake.projects)
+    (CONFIG_DIR / "projects.toml").write_text(
+        f"[projects]\n{projects}\n\n[page]\nentries = [\n{entries}\n]\n"
+    )
+
+
+def make_tickertock(fake, with_images=False):
+    from tickertock.tickertock import Tickertock
+
+    write_config(fake)
+    tickertock = Tickertock("clockify")
+    tickertock.initialize(with_images=with_images)
+    return tickertock
+
+
+@benchmark("api_sync")
+def bench_api_sync(args, fake):
+    """
+    One in-progress poll, as done on every sync tick.
+    """
+
+    from tickertock.clockify import ClockifyTocker
+
+    tocker = ClockifyTocker("bench", fake.workspace_id, api_url=fake.url)
+    tocker.initialize()
+    fake.reset()
+    timings = measure(tocker.sync, args.repeat)
+    return summarize(timings, requests=len(fake.requests))
+
+
+@benchmark("toggle")
+def bench_toggle(args, fake):
+    """
+    Journal and send a project start, as the worker does after a
+    keypress - keypress-to-API latency, minus the deck.
+    """
+
+    tickertock = make_tickertock(fake)
+    codes = tickertock.entries
+    counter = iter(range(10**9))
+    timings = measure(lambda: tickertock.toggle(codes[next(counter) % len(codes)]), args.repeat)
+    return summarize(timings, pending=tickertock.journal.pending_count())
+
+
+@benchmark("draw_time")
+def bench_draw_time(args, fake):
+    try:
+        from tickertock import utils
+    except ImportError as e:
+        raise Skipped(str(e))
+
+    utils.CLOCK_FACES.clear()
+    minutes = iter(range(10**9))
+    uncached = measure(lambda: utils.render_clock(1, next(minutes) % 60), args.repeat)
+    utils.CLOCK_FACES.warm()
+    cached = measure(lambda: utils.draw_time(60 * (next(minutes) % 60)), args.repeat)
+    return {
+        "render": summarize(uncached, per_second=len(uncached) / sum(uncached)),
+        "cached": summarize(cached, per_second=len(cached) / sum(cached)),
+    }
+
+
+@benchmark("draw_colour")
+def bench_draw_colour(args, fake):
+    try:
+        from tickertock import utils
+    except ImportError as e:
+        raise Skipped(str(e))
+
+    colours = iter(range(10**9))
+    timings = measure(
+        lambda: utils.draw_colour("Bench", f"{next(colours) % 0x1000000:06X}"), args.repeat
+    )
+    return summarize(timings, per_second=len(timings) / sum(timings))
+
+
+@benchmark("native_frames")
+def bench_native_frames(args, fake):
+    """
+    Getting a drawn button image into a deck's native format: from
+    a PNG, as streamdeck_ui does, straight from the pixels, and from
+    the cache of encoded frames.
+    """
+
+    from io import BytesIO
+
+    try:
+        from PIL import Image
+        from StreamDeck.ImageHelpers import PILHelper
+        from tickertock.frames import KeyFrame, NativeFrameCache
+    except ImportError as e:
+        raise Skipped(str(e))
+
+    deck = FakeStreamDeck("FRAMES")
+    size = deck.key_image_format()["size"]
+    frames = [
+        KeyFrame(("bench", n), image=Image.new("RGBA", size, (n, 255 - n, 128, 255)))
+        for n in range(256)
+    ]
+    pngs = [frame.getvalue() for frame in frames]
+    counter = iter(range(10**9))
+
+    def from_png():
+        image = Image.open(BytesIO(pngs[next(counter) % len(pngs)]))
+        PILHelper.to_native_key_format(deck, image.convert("RGB"))
+
+    cache = NativeFrameCache(maxsize=len(frames))
+    uncached = NativeFrameCache(maxsize=0)
+    return {
+        "from_png": summarize(measure(from_png, args.repeat)),
+        "from_pixels": summarize(
+            measure(lambda: uncached.get(deck, frames[next(counter) % 256], None), args.repeat)
+        ),
+        "cached": summarize(
+            measure(lambda: cache.get(deck, frames[next(counter) % 256], None), args.repeat, 256)
+        ),
+    }
+
+
+@benchmark("webhook_latency")
+def bench_webhook(args, fake):
+    """
+    Time from a timer being started elsewhere (the browser, say)
+    to the tocker's state showing it, through the webhook receiver
+    rather than waiting for a poll.
+    """
+
+    from tickertock.clockify import ClockifyTocker
+    from tickertock.webhooks import WebhookReceiver
+
+    tocker = ClockifyTocker("bench", fake.workspace_id, api_url=fake.url)
+    tocker.initialize()
+    receiver = WebhookReceiver(tocker.apply_webhook, 0, tokens=["bench-token"])
+    receiver.start()
+    fake.subscribe(receiver.url, "bench-token")
+
+    def start_elsewhere(n):
+        entry = fake.start_elsewhere(n % len(fake.projects))
+        deadline = time.perf_counter() + 5
+        while tocker.active_entry != entry["id"]:
+            if time.perf_counter() > deadline:
+                raise Skipped("Webhook never arrived")
+            time.sleep(0.0005)
+
+    counter = iter(range(10**9))
+    try:
+        timings = measure(lambda: start_elsewhere(next(counter)), args.repeat)
+    finally:
+        receiver.stop()
+        fake.subscribers.clear()
+    return summarize(timings, requests=len(fake.requests))
+
+
+@benchmark("merge_streamdeck_config")
+def bench_merge(args, fake):
+    """
+    Deck configuration build, against project count and deck count,
+    with the layout cache cleared so every run is a full build.
+    """
+
+    from tickertock import deckconfig
+
+    results = {}
+    for projects in (10, 100, 500):
+        for decks in (1, 4):
+            tickertock = types.SimpleNamespace(
+                entries=[f"P{i}" for i in range(projects)],
+                projects={f"P{i}": {"name": f"P{i}"} for i in range(projects)},
+            )
+
+            def build():
+                deckconfig._layouts.clear()
+                deckconfig.merge_streamdeck_config(
+                    tickertock,
+                    {"state": {f"deck{d}": {} for d in range(decks)}},
+                    lambda device: {"layout": (3, 5)},
+                )
+
+            results[f"{projects}_projects_{decks}_decks"] = summarize(
+                measure(build, args.repeat)
+            )
+    return results
+
+
+@benchmark("cli_cold_start")
+def bench_cli(args, fake):
+    make_tickertock(fake)
+    env = dict(os.environ)
+    command = [sys.executable, "-m", "tickertock.scripts.tickertock"]
+    repeat = max(3, args.repeat // 10)
+
+    def run(*argv):
+        subprocess.run(command + list(argv), env=env, check=True, capture_output=True)
+
+    return {
+        "version": summarize(measure(lambda: run("version"), repeat)),
+        "toggle": summarize(
+            measure(lambda: run("toggle", "--direct", fake.projects[0]["name"]), repeat)
+        ),
+    }
+
+
+class _FakeTray:
+    def setIcon(self, icon):
+        pass
+
+    def showMessage(self, *args):
+        pass
+
+
+def ui_harness(fake, decks):
+    """
+    A TickertockApplication driving `decks` fake 15-key decks through
+    the real streamdeck_ui display pipeline, without a window or tray.
+    """
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        from PySide6.QtCore import QTimer
+        from PySide6.QtWidgets import QApplication
+        from tickertock.ui import (
+            TickertockApplication,
+            TickertockStreamDeckServer,
+            merge_streamdeck_config,
+        )
+        from tickertock.worker import TockerWorker
+    except ImportError as e:
+        raise Skipped(str(e))
+
+    QApplication.instance() or QApplication([])
+    tickertock = make_tickertock(fake, with_images=True)
+    server = TickertockStreamDeckServer(tickertock)
+    fakes = {f"BENCH{i}": FakeStreamDeck(f"BENCH{i}") for i in range(decks)}
+    server.state = merge_streamdeck_config(
+        tickertock,
+        {"state": {serial: {} for serial in fakes}},
+        lambda serial: {"layout": fakes[serial].key_layout()},
+        with_images=True,
+    )["state"]
+    server._save_state = lambda: None
+    for deck in fakes.values():
+        server.attached(deck.id(), deck)
+
+    application = TickertockApplication(tickertock)
+    application.api = server
+    application.tray = _FakeTray()
+    application.worker = TockerWorker(lambda *args: None)
+    application.worker.start()
+    application.render_timer = QTimer()
+    application.render_timer.setSingleShot(True)
+    application.timer = QTimer()
+    application.timer.setSingleShot(True)
+    application.flush_timer = QTimer()
+    application.flush_timer.setSingleShot(True)
+
+    def close():
+        application.worker.stop()
+        for deck in fakes.values():
+            server.cleanup(deck.id(), deck.serial)
+
+    return application, fakes, close
+
+
+@benchmark("tick_cost")
+def bench_tick(args, fake):
+    """
+    Cost of a sync tick (one poll plus redrawing every deck),
+    against the number of attached decks.
+    """
+
+    results = {}
+    for decks in (1, 2, 4, 8):
+        application, fakes, close = ui_harness(fake, decks)
+        try:
+            tocker = application.tickertock.tocker
+            tickertock = application.tickertock
+            tickertock.toggle(tickertock.entries[0])
+            fake.reset()
+
+            def tick():
+                application.update_decks(tocker.sync())
+
+            timings = measure(tick, max(3, args.repeat // 5))
+            results[f"{decks}_decks"] = summarize(
+                timings, requests_per_tick=len(fake.requests) / (len(timings) + 1)
+            )
+        finally:
+            close()
+    return results
+
+
+@benchmark("keypress_latency")
+def bench_keypress(args, fake):
+    """
+    Time from a project keypress to the status button image
+    reaching the (fake) deck.
+    """
+
+    application, fakes, close = ui_harness(fake, 1)
+    try:
+        deck = next(iter(fakes.values()))
+        status_key = deck.key_count() - 1
+        timings = []
+        for n in range(max(3, args.repeat // 5)):
+            application.api.set_page(deck.serial, 0)
+            start = time.perf_counter()
+            application.handle_keypress_additional(deck.serial, n % status_key, True)
+            pushed = deck.wait_for_push(status_key, start)
+            if pushed is None:
+                raise Skipped("Status button was never redrawn")
+            timings.append(pushed - start)
+        return summarize(timings)
+    finally:
+        close()
+
+
+@benchmark("headless_footprint")
+def bench_headless(args, fake):
+    """
+    Memory, threads and idle CPU of the headless application on one
+    fake deck, in a process of its own.
+    """
+
+    from .headless_probe import SKIPPED
+
+    make_tickertock(fake)
+    result = subprocess.run(
+        [sys.executable, "-m", "benchmarks.headless_probe", "10"],
+        env=dict(os.environ),
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode == SKIPPED:
+        raise Skipped(result.stderr.strip())
+    if result.returncode:
+        raise RuntimeError(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(old, new):
+    """
+    Print the change in median time for every result in both runs.
+    """
+
+    def flatten(results, prefix=""):
+        for name, result in results.items():
+            if isinstance(result, dict) and "median_ms" in result:
+                yield prefix + name, result["median_ms"]
+            elif isinstance(result, dict):
+                yield from flatten(result, f"{prefix}{name}.")
+
+    before = dict(flatten(old["results"]))
+    print(f"{'benchmark':50} {old['version']:>12} {new['version']:>12} {'change':>8}")
+    for name, median in flatten(new["results"]):
+        if name in before:
+            change = (median - before[name]) / before[name] * 100 if before[name] else 0
+            print(f"{name:50} {before[name]:10.2f}ms {median:10.2f}ms {change:+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--only", nargs="*", choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--projects", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.0, help="Added to each API call (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of API calls that fail")
+    args = parser.parse_args()
+
+    fake = FakeClockify(
+        projects=args.projects, latency=args.latency, error_rate=args.error_rate
+    ).start()
+
+    results = {}
+    try:
+        for name in args.only or BENCHMARKS:
+            print(f"Running {name}...", file=sys.stderr)
+            fake.reset()
+            try:
+                results[name] = BENCHMARKS[name](args, fake)
+            except Skipped as e:
+                results[name] = {"skipped": str(e)}
+    finally:
+        fake.stop()
+
+    output = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.datetime.utcnow().isoformat(),
+        "settings": {
+            "repeat": args.repeat,
+            "projects": args.projects,
+            "latency": args.latency,
+            "error_rate": args.error_rate,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,658 @@
+"""
+Everything that drives the decks without caring what is showing
+them: syncing, toggling, paging, the clock and the totals. The Qt
+application (ui.py) and the headless driver (headless.py) each add
+their own deck access, timers and event loop on top.
+"""
+
+import logging
+from functools import partial
+from collections import OrderedDict
+
+from .utils import draw_time, draw_caption, CLOCK_FACES, RENDERER
+from .deckconfig import deck_layout, page_buttons
+from .tickertock import TOCKERS, JOURNAL_BATCH_SIZE
+from .watcher import ConfigWatcher
+from .worker import TockerWorker
+from .control import ControlServer
+from .config import CACHE_DIR, CONFIG_DIR
+from .metrics import METRICS, METRICS_PATH
+from .scheduler import SyncScheduler, MAX_INTERVAL
+from .webhooks import WebhookReceiver
+from .timesheet import format_total
+from .updates import DeckUpdates, batched, MAX_FRAME_RATE
+from .assets import ProjectAssets
+from .pages import DeckPages, RESIDENT_PAGES
+
+# Make sure the minute has definitely ticked over when we redraw
+RENDER_SLACK_MS = 50
+
+METRICS_INTERVAL_MS = 60000
+# Worker commands with nothing to show on the decks
+QUIET_COMMANDS = ("metrics",)
+# With webhooks bringing changes in, polling is just a safety net
+WEBHOOK_SYNC_RATE_MS = 600000
+CAPTION_CACHE_SIZE = 128
+
+
+class DeckApplication:
+    """
+    Base for the things that run the decks. Subclasses provide
+    `self.api` (with the streamdeck_ui server's button and page
+    methods), `make_timer` and, optionally, a tray.
+
+    All methods are called on the one UI thread - anything from
+    another thread comes in through `invoke`.
+    """
+
+    def __init__(self, tickertock):
+        self.tickertock = tickertock
+        self.api = None
+        self.worker = None
+        self.webhooks = None
+        self.control = None
+        self.watcher = None
+        self.metrics_server = None
+        self.scheduler = SyncScheduler(*self.sync_intervals())
+        self._clock = None
+        self._tray_project = None
+        self._snapshot = None
+        self._captions = {}
+        self._captioned = OrderedDict()
+        self.pages = DeckPages(tickertock.config.get("residentPages", RESIDENT_PAGES))
+        self._offline = False
+        self._updates = None
+        self.assets = ProjectAssets(tickertock, self.make_icon)
+
+    @property
+    def updates(self):
+        """
+        Button and page changes go through here rather than straight
+        to the api, so each deck gets them in one go.
+        """
+
+        if self._updates is None or self._updates.api is not self.api:
+            self._updates = DeckUpdates(
+                self.api,
+                self.make_timer,
+                self.tickertock.config.get("maxFrameRate", MAX_FRAME_RATE),
+            )
+        return self._updates
+
+    def make_timer(self, callback, single_shot=True, precise=False):
+        """
+        A timer calling `callback` on the UI thread, with QTimer's
+        start(ms), stop() and isActive().
+        """
+
+        raise NotImplementedError
+
+    def make_icon(self, image):
+        """
+        A tray icon for a project image (a KeyFrame or path), or for
+        no project if None - or None if there is no tray.
+        """
+
+        return None
+
+    def show_tray_project(self, code):
+        pass
+
+    def warn(self, message):
+        logging.warning(message)
+
+    def page_capacity(self, deck_id):
+        """
+        How many pages the deck can show, or None if unlimited.
+        """
+
+        return None
+
+    def handle_update_time(self):
+        """
+        Periodically make sure everything is synced, including
+        clock on the bottom-right button. The sync happens on
+        the worker, and the decks are updated once it is back.
+        """
+
+        self.submit_flush()
+        self.worker.submit("sync", self.tickertock.tocker.sync, coalesce=True)
+        if self.tickertock.totals_period:
+            self.worker.submit(
+                "timesheet", self.tickertock.refresh_timesheet, coalesce=True
+            )
+        if self.tickertock.tocker.projects.is_stale:
+            self.worker.submit(
+                "projects", self.tickertock.tocker.refresh_projects, coalesce=True
+            )
+
+    def submit_flush(self):
+        self.worker.submit(
+            "flush",
+            self.tickertock.flush,
+            JOURNAL_BATCH_SIZE,
+            self.tickertock.coalesce_window,
+            coalesce=True,
+        )
+
+    def handle_webhook(self, event, payload):
+        self.worker.submit("webhook", self.tickertock.tocker.apply_webhook, event, payload)
+
+    def schedule_sync(self):
+        """
+        (Re)start the sync timer for whenever the scheduler says,
+        or stop it while paused.
+        """
+
+        delay = self.scheduler.next_delay()
+        if delay is None:
+            self.timer.stop()
+        else:
+            self.timer.start(int(delay * 1000))
+
+    def handle_away(self):
+        logging.info("Session locked or asleep - pausing sync")
+        self.scheduler.pause()
+        self.timer.stop()
+
+    def handle_back(self):
+        logging.info("Session back - syncing")
+        self.scheduler.resume()
+        self.handle_update_time()
+
+    def clock_image(self, snapshot):
+        """
+        Clockface for a snapshot, drawn once and shared between
+        all decks until the minute changes.
+        """
+
+        key = snapshot.clock_key
+        if self._clock is None or self._clock[0] != key:
+            image = draw_time(snapshot.elapsed().total_seconds())
+            self._clock = (key, image)
+        return self._clock[1]
+
+    @METRICS.timed("tickertock_tick_seconds")
+    @batched
+    def update_decks(self, snapshot=None):
+        """
+        Redraw the bottom-right button on every deck, and the tray,
+        from one snapshot of the tracking state, without touching
+        the network.
+        """
+
+        if snapshot is None:
+            snapshot = self.tickertock.tocker.snapshot()
+        self._snapshot = snapshot
+        self.schedule_render()
+
+        project = snapshot.project
+        if project != self._tray_project:
+            self.show_tray_project(project)
+            self._tray_project = project
+
+        self.update_totals(snapshot)
+
+        if not project:
+            return
+
+        image = self.clock_image(snapshot)
+        for deck_id, _ in self.api.state.items():
+            deck = self.api.decks.get(deck_id, None)
+            if deck:
+                page = self.updates.get_page(deck_id)
+                layout = self.api.get_deck(deck_id)["layout"]
+                key_count = layout[0] * layout[1]
+                text = self.updates.get_button_text(
+                    deck_id, page if page != 1 else 0, key_count - 1
+                )
+
+                if text != f"@{project}":
+                    self.show_page(deck_id, 0, key_count)
+                    self.updates.set_button_text(
+                        deck_id, 0, key_count - 1, f"@{project}"
+                    )
+                self.updates.set_button_icon(deck_id, 0, key_count - 1, image)
+
+    @batched
+    def update_totals(self, snapshot):
+        """
+        Caption each project button with the time tracked on it
+        this period, from the local timesheet, redrawing only the
+        buttons whose caption changed.
+        """
+
+        if not self.tickertock.totals_period:
+            return
+
+        captions = {
+            code: format_total(seconds) if seconds >= 60 else None
+            for code, seconds in self.tickertock.project_totals(snapshot).items()
+        }
+        changed = {
+            code: caption
+            for code, caption in captions.items()
+            if self._captions.get(code) != caption
+        }
+        if not changed:
+            return
+
+        self._captions.update(changed)
+        for deck_id in list(self.api.decks):
+            layout = self.api.get_deck(deck_id)["layout"]
+            key_count = layout[0] * layout[1]
+            buttons = deck_layout(self.tickertock, key_count)["buttons"]
+            for page in self.built_pages(deck_id, key_count):
+                for button, settings in buttons.get(page, {}).items():
+                    code = settings.get("text")
+                    if code in changed:
+                        self.updates.set_button_icon(
+                            deck_id, page, button, self.project_icon(code)
+                        )
+
+    def project_icon(self, code):
+        """
+        A project's button image, captioned with its total, if it
+        has one. Captioned images are kept for the recently shown.
+        """
+
+        image = self.tickertock.project_image(code)
+        caption = self._captions.get(code)
+        if not image or not caption:
+            return image or ""
+
+        cached = self._captioned.get(code)
+        if cached is None or cached[:2] != (image, caption):
+            cached = (image, caption, draw_caption(image, caption))
+            self._captioned[code] = cached
+            while len(self._captioned) > CAPTION_CACHE_SIZE:
+                self._captioned.popitem(last=False)
+        self._captioned.move_to_end(code)
+        return cached[2]
+
+    def page_built(self, deck_id, page, key_count):
+        return any(
+            settings.get("text") or settings.get("icon")
+            for settings in (
+                self.updates.button(deck_id, page, button) for button in range(key_count)
+            )
+        )
+
+    def built_pages(self, deck_id, key_count):
+        pages = deck_layout(self.tickertock, key_count)["buttons"]
+        return [page for page in pages if self.page_built(deck_id, page, key_count)]
+
+    @batched
+    def build_page(self, deck_id, page, key_count):
+        buttons = page_buttons(self.tickertock, key_count, page)
+        for button in range(key_count):
+            if page == 0 and button == key_count - 1:
+                # Status button is kept up to date separately
+                continue
+            settings = buttons.get(button, {})
+            code = settings.get("text", "")
+            icon = self.project_icon(code) if code in self.tickertock.projects else None
+            self.updates.set_button_text(deck_id, page, button, code)
+            self.updates.set_button_icon(deck_id, page, button, icon or settings.get("icon", ""))
+
+    @batched
+    def drop_page(self, deck_id, page, key_count):
+        for button in range(key_count):
+            self.updates.set_button_text(deck_id, page, button, "")
+            self.updates.set_button_icon(deck_id, page, button, "")
+
+    @batched
+    def show_page(self, deck_id, page, key_count):
+        """
+        Switch a deck to a page, building it first if need be,
+        dropping the least recently shown if too many are built,
+        and drawing the pages either side in the background.
+        """
+
+        for old in self.pages.show(deck_id, page):
+            self.drop_page(deck_id, old, key_count)
+        if not self.page_built(deck_id, page, key_count):
+            self.build_page(deck_id, page, key_count)
+        self.updates.set_page(deck_id, page)
+
+        layout = deck_layout(self.tickertock, key_count)["buttons"]
+        codes = [
+            settings["text"]
+            for neighbour in self.pages.neighbours(page, self.assets.page_count(key_count))
+            for settings in layout.get(neighbour, {}).values()
+            if "text" in settings
+        ]
+        missing = self.tickertock.missing_images(codes)
+        if missing:
+            self.render_later("prefetch", self.tickertock.project_images, missing)
+
+    def render_later(self, name, function, *args):
+        """
+        Draw something nothing is waiting on, on the render thread,
+        so it holds up neither the decks nor the API worker.
+        """
+
+        future = RENDERER.submit(function, *args)
+        future.add_done_callback(partial(self._rendered, name))
+
+    def _rendered(self, name, future):
+        error = future.exception()
+        if error is not None:
+            logging.error(f"{name} failed: {error}")
+
+    def schedule_render(self):
+        """
+        Wake up just after the clockface next changes, so the clock
+        moves every minute on the minute, independent of syncing.
+        """
+
+        snapshot = self._snapshot
+        if not snapshot or not snapshot.project or not snapshot.started:
+            self.render_timer.stop()
+            return
+        wait = snapshot.until_next_minute()
+        self.render_timer.start(int(wait * 1000) + RENDER_SLACK_MS)
+
+    def handle_render_tick(self):
+        """
+        Redraw the clock from the last snapshot - sync only
+        re-anchors it, so there is no network call here.
+        """
+
+        if self._snapshot is not None:
+            self.update_decks(self._snapshot)
+        if self.scheduler.woke() and not self.scheduler.paused:
+            # Slept without anyone saying, so do not wait to catch up
+            self.handle_update_time()
+
+    def handle_command_finished(self, command, result, error):
+        """
+        Reconcile the decks with whatever the tocker said, warning
+        (once) if journalled toggles could not be replayed yet.
+        """
+
+        if command.name == "flush":
+            if error and not self._offline:
+                self.warn(
+                    "Could not reach the timetracker - toggles are saved and will be replayed"
+                )
+            self._offline = bool(error)
+            rejected = self.tickertock.take_rejected()
+            for event in rejected:
+                self.warn(f"The timetracker rejected the toggle to {event.project}")
+            if rejected:
+                self.worker.submit("sync", self.tickertock.tocker.sync, coalesce=True)
+        elif command.name == "sync":
+            previous = self._snapshot
+            changed = not error and (
+                previous is None
+                or (previous.project_id, previous.entry_id)
+                != (result.project_id, result.entry_id)
+            )
+            self.scheduler.synced(
+                changed, error, self.tickertock.tocker.session.throttled_for
+            )
+            self.schedule_sync()
+        if command.name in QUIET_COMMANDS:
+            return
+        if self.api:
+            # Not the result's snapshot - a toggle since it was taken
+            # is newer, and the tocker already has the result in it
+            self.update_decks()
+
+    @batched
+    def show_active(self, deck_id, key_count, code):
+        """
+        Show a project (or nothing, if code is None) as
+        running on the deck and the tray.
+        """
+
+        if code:
+            self.updates.set_button_text(deck_id, 0, key_count - 1, f"@{code}")
+        else:
+            self.updates.set_button_text(deck_id, 0, key_count - 1, "NOT RUN")
+        self.show_tray_project(code)
+        self._tray_project = code
+
+    def apply_toggle(self, toggle_to):
+        """
+        Journal a toggle and update local state straight away, then
+        leave the worker to replay it to the tocker. If it cannot
+        be journalled, local state is put back and False returned.
+        """
+
+        # Together, so a flush finishing meanwhile cannot put back
+        # the state from before this toggle
+        with self.tickertock.tocker.state_lock:
+            previous = self.tickertock.optimistic_toggle(toggle_to)
+            when = self.tickertock.tocker.when
+            event = self.tickertock.record_toggle(toggle_to, when)
+            if event is None:
+                self.tickertock.tocker.restore_state(previous)
+        if event is None:
+            if toggle_to in self.tickertock.projects and not self.tickertock.knows_project(toggle_to):
+                # Perhaps only just added - fetch the projects on the
+                # worker, so the next press can find it
+                self.worker.submit(
+                    "projects", self.tickertock.tocker.refresh_projects, coalesce=True
+                )
+                self.warn(f"{toggle_to} is not in the timetracker yet - refreshing projects")
+            else:
+                self.warn(f"Could not toggle {toggle_to}")
+            return False
+
+        # Wait for the burst to end, so only the final state is sent
+        self.flush_timer.start(int(self.tickertock.coalesce_window * 1000) + RENDER_SLACK_MS)
+        self.scheduler.toggled()
+        self.schedule_sync()
+        return True
+
+    @batched
+    def handle_control(self, request):
+        """
+        Answer a request from the control socket, on the UI thread,
+        so CLI toggles show on the decks straight away.
+        """
+
+        if request["command"] == "stats":
+            return {"ok": True, "metrics": METRICS.render()}
+
+        if request["command"] != "status":
+            toggle_to = request.get("project", "None")
+            if request["command"] == "stop":
+                toggle_to = "None"
+            if not self.apply_toggle(toggle_to):
+                return {"ok": False, "error": f"Unknown project {toggle_to}"}
+
+            code = toggle_to if toggle_to != "None" else None
+            for deck_id in list(self.api.decks):
+                layout = self.api.get_deck(deck_id)["layout"]
+                self.show_active(deck_id, layout[0] * layout[1], code)
+            self.update_decks()
+
+        snapshot = self.tickertock.tocker.snapshot()
+        elapsed = snapshot.elapsed() if snapshot.project else None
+        return {
+            "ok": True,
+            "project": snapshot.project,
+            "elapsed": elapsed.total_seconds() if elapsed else None,
+        }
+
+    def handle_config_changed(self, name):
+        """
+        Apply an edit to projects.toml or config.toml in place,
+        rather than restarting everything.
+        """
+
+        if name == "projects.toml":
+            changed, entries_changed = self.tickertock.reload_projects()
+            logging.info(f"Reloaded projects: {len(changed)} changed")
+            if changed or entries_changed:
+                self.assets.rebuild()
+                self.refresh_buttons()
+        elif name == "config.toml":
+            changed = self.tickertock.reload_config()
+            logging.info(f"Reloaded config: {', '.join(sorted(changed)) or 'no changes'}")
+            if changed & {"syncRate", "maxSyncRate", "webhookSyncRate"}:
+                self.scheduler.configure(*self.sync_intervals())
+                self.schedule_sync()
+            if changed & set(TOCKERS):
+                logging.warning("Timetracker settings changed - restart tickertock to apply")
+
+    @batched
+    def refresh_buttons(self):
+        """
+        Bring every deck into line with the current projects:
+        rebuild the pages it has built and drop any no longer
+        needed. The update only pushes the buttons that differ.
+        """
+
+        for deck_id in list(self.api.decks):
+            layout = self.api.get_deck(deck_id)["layout"]
+            key_count = layout[0] * layout[1]
+            target = deck_layout(self.tickertock, key_count)["buttons"]
+            current = self.api.state[deck_id].get("buttons", {})
+            capacity = self.page_capacity(deck_id)
+            shown = self.updates.get_page(deck_id)
+
+            for page in sorted(set(target) | set(current)):
+                if capacity is not None and page >= capacity:
+                    logging.warning(
+                        f"Deck {deck_id} needs more pages - restart tickertock to show them all"
+                    )
+                    break
+                built = self.page_built(deck_id, page, key_count)
+                if page in target and (built or page == shown):
+                    self.build_page(deck_id, page, key_count)
+                elif built:
+                    self.drop_page(deck_id, page, key_count)
+
+    @METRICS.timed("tickertock_keypress_seconds")
+    @batched
+    def handle_keypress_additional(self, deck_id: str, key: int, state: bool) -> None:
+        """
+        Confuse anyone who is looking at handle_keypress in streamdeck_ui in the naive
+        hope that that's where the logic is.
+
+        The toggle is journalled and the deck updated straight away
+        from local state, then the journal is replayed to the tocker
+        on the worker.
+        """
+
+        if not state:
+            return
+
+        page = self.updates.get_page(deck_id)
+        layout = self.api.get_deck(deck_id)["layout"]
+        key_count = layout[0] * layout[1]
+        text = self.updates.get_button_text(deck_id, page if page != 1 else 0, key)
+        if text and key != key_count - 1:
+            toggle_to = text
+        else:
+            toggle_to = "None"
+
+        if toggle_to == "None" and self.tickertock.tocker.snapshot().project_id is None:
+            # Just paging - nothing is running, so there is nothing to stop
+            self.show_active(deck_id, key_count, None)
+        elif self.apply_toggle(toggle_to):
+            self.show_active(deck_id, key_count, text if toggle_to != "None" else None)
+        else:
+            self.show_active(deck_id, key_count, self.tickertock.tocker.snapshot().project)
+
+        page_count = self.assets.page_count(key_count)
+        # We do not know the original page
+        # switch_page = api.get_button_switch_page(deck_id, page, key)
+        if key != key_count - 1:
+            self.show_page(deck_id, 0, key_count)
+            self.update_decks()
+        elif text.startswith("@"):
+            self.show_page(deck_id, 1, key_count)
+        elif page > 0:
+            self.show_page(deck_id, page % (page_count - 1) + 1, key_count)
+        else:
+            self.show_page(deck_id, min(page_count - 1, 2), key_count)
+
+    def sync_intervals(self):
+        config = self.tickertock.config
+        interval = config["syncRate"]
+        if self.webhooks:
+            interval = config.get("webhookSyncRate", WEBHOOK_SYNC_RATE_MS)
+        return (
+            interval / 1000,
+            config.get("maxSyncRate", MAX_INTERVAL * 1000) / 1000,
+        )
+
+
+    def start_worker(self, invoke):
+        """
+        Start the worker and the timers. `invoke(function, *args)`
+        must queue a call onto the UI thread.
+        """
+
+        self.worker = TockerWorker(partial(invoke, self.handle_command_finished))
+        self.worker.start()
+
+        if self.tickertock.config.get("persistClockFaces", True):
+            CLOCK_FACES.persist_to(CACHE_DIR / "clock")
+        self.render_later("warm", CLOCK_FACES.warm)
+
+        # Single shot, re-armed each time a sync comes back
+        self.timer = self.make_timer(self.handle_update_time)
+        self.render_timer = self.make_timer(self.handle_render_tick, precise=True)
+        self.flush_timer = self.make_timer(self.submit_flush, precise=True)
+        self.metrics_timer = self.make_timer(
+            lambda: self.worker.submit("metrics", METRICS.write, METRICS_PATH, coalesce=True),
+            single_shot=False,
+        )
+
+    def start_services(self, invoke, call):
+        """
+        Once the decks are up: sync, and start listening to the
+        control socket, webhooks and config edits. `call` is like
+        `invoke`, but waits for the result.
+        """
+
+        self.assets.warm()
+        self.handle_update_time()
+
+        self.control = ControlServer(partial(call, self.handle_control))
+        self.control.start()
+
+        tocker = self.tickertock.tocker
+        if tocker.webhook_port:
+            self.webhooks = WebhookReceiver(
+                partial(invoke, self.handle_webhook),
+                tocker.webhook_port,
+                tocker.webhook_host,
+                tocker.webhook_tokens,
+            )
+            if self.webhooks.start():
+                # Our own toggles come back as webhooks too
+                self.scheduler.fast_window = 0
+                self.scheduler.configure(*self.sync_intervals())
+            else:
+                self.webhooks = None
+
+        self.watcher = ConfigWatcher(
+            CONFIG_DIR,
+            ("projects.toml", "config.toml"),
+            partial(invoke, self.handle_config_changed),
+        )
+        self.watcher.start()
+
+        self.metrics_timer.start(METRICS_INTERVAL_MS)
+        if self.tickertock.config.get("metricsPort"):
+            try:
+                self.metrics_server = METRICS.serve(self.tickertock.config["metricsPort"])
+            except OSError as e:
+                logging.error(f"Could not serve metrics: {e}")
+
+    def stop_services(self):
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        METRICS.write(METRICS_PATH)
+        self.watcher.stop()
+        if self.webhooks:
+            self.webhooks.stop()
+        self.control.stop()
+        self.worker.stop()
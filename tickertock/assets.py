@@ -0,0 +1,77 @@
+"""
+What the UI needs about each project on a keypress - its tray icon
+and how many pages the entries take - worked out when projects load
+or change, rather than on every press. Deck images themselves are
+drawn with their page (see pages.py).
+"""
+
+from collections import OrderedDict
+
+from .frames import frame_key
+
+ICON_CACHE_SIZE = 64
+
+
+class ProjectAssets:
+    """
+    Per-project bundle, rebuilt with `rebuild()` when projects.toml
+    changes. Tray icons come from `make_icon(image)` - None for no
+    project - and are kept in a bounded LRU keyed on what was drawn,
+    so a rebuild only makes icons for images that changed. `warm()`
+    makes them up front for the first entries with images already
+    to hand - it never draws tiles.
+    """
+
+    def __init__(self, tickertock, make_icon=None, icon_cache_size=ICON_CACHE_SIZE):
+        self.tickertock = tickertock
+        self.make_icon = make_icon
+        self.icon_cache_size = icon_cache_size
+        self._icons = OrderedDict()
+        self.rebuild()
+
+    def rebuild(self):
+        self.entries = list(self.tickertock.entries)
+        self._page_counts = {}
+
+    def warm(self):
+        if self.make_icon is None:
+            return
+        self.icon(None)
+        entries = self.entries[: self.icon_cache_size - 1]
+        undrawn = set(self.tickertock.missing_images(entries))
+        for code in entries:
+            if code not in undrawn:
+                self.icon(code)
+
+    def icon(self, code):
+        """
+        The tray icon for a project (or for none), if there is a
+        `make_icon`.
+        """
+
+        if self.make_icon is None:
+            return None
+
+        image = self.tickertock.project_image(code) if code else None
+        key = frame_key(image)
+        if key in self._icons:
+            self._icons.move_to_end(key)
+            return self._icons[key]
+
+        icon = self.make_icon(image)
+        self._icons[key] = icon
+        while len(self._icons) > self.icon_cache_size:
+            self._icons.popitem(last=False)
+        return icon
+
+    def page_count(self, key_count):
+        """
+        Pages needed for the entries on a deck with this many keys,
+        one key being kept for the status button, plus the first.
+        """
+
+        if key_count not in self._page_counts:
+            self._page_counts[key_count] = (
+                round(len(self.entries) / (key_count - 1) + 0.4999) + 1
+            )
+        return self._page_counts[key_count]
@@ -1,5 +1,28 @@
-import requests
+import os
+import json
+import logging
 import datetime
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from .session import TockerSession
+from .registry import ProjectRegistry
+from .state import TrackerSnapshot
+
+API_URL = "https://api.clockify.me/api/v1"
+PROJECTS_PAGE_SIZE = 200
+PROJECTS_CONCURRENCY = 4
+ENTRIES_PAGE_SIZE = 200
+
+PROJECT_EVENTS = ("NEW_PROJECT", "PROJECT_UPDATED", "PROJECT_DELETED")
+
+
+def format_time(when):
+    return when.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value.replace("T", " ").rstrip("Z"))
 
 
 class ClockifyTocker:
@@ -15,43 +38,170 @@ class ClockifyTocker:
 
     @classmethod
     def from_config(cls, config):
-        return cls(api_key=config["apiKey"], workspace_id=config["workspaceId"])
+        session_options = {
+            option: config[key]
+            for option, key in (
+                ("connect_timeout", "connectTimeout"),
+                ("read_timeout", "readTimeout"),
+                ("retries", "retries"),
+            )
+            if key in config
+        }
+        return cls(
+            api_key=config["apiKey"],
+            workspace_id=config["workspaceId"],
+            projects_ttl=config.get("projectsTtl", 3600),
+            api_url=config.get("apiUrl", API_URL),
+            webhook_port=config.get("webhookPort"),
+            webhook_host=config.get("webhookHost", "127.0.0.1"),
+            webhook_tokens=config.get("webhookTokens", ()),
+            **session_options,
+        )
 
-    def __init__(self, api_key, workspace_id):
+    def __init__(
+        self,
+        api_key,
+        workspace_id,
+        projects_ttl=3600,
+        api_url=API_URL,
+        webhook_port=None,
+        webhook_host="127.0.0.1",
+        webhook_tokens=(),
+        **session_options,
+    ):
         self.api_key = api_key
         self.workspace_id = workspace_id
+        self.webhook_port = webhook_port
+        self.webhook_host = webhook_host
+        self.webhook_tokens = webhook_tokens
         self.when = None
+        self.session = TockerSession(
+            api_url,
+            headers={
+                "Content-Type": "application/json",
+                "X-Api-Key": self.api_key,
+            },
+            **session_options,
+        )
 
         self.active_project = None
         self.active_project_id = None
         self.active_entry = None
+        # Held for any read or write of the tracking state above, which
+        # the worker and the UI thread both touch
+        self.state_lock = threading.RLock()
+        self.projects = ProjectRegistry(projects_ttl)
+        self.cache_path = None
+        # Where to record every time entry we see, if anywhere
+        self.timesheet = None
+
+    def initialize(self, cache_path=None, refresh=False):
+        """
+        Load the project registry from cache_path, only fetching it
+        from Clockify now if there is no usable cache, or `refresh`
+        is set. A stale cache is left for refresh_projects_if_stale
+        to update in the background.
+        """
+
+        self.cache_path = cache_path
+        if refresh or not self._load_cache():
+            self.refresh_projects()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                cache = json.load(f)
+        except (TypeError, OSError, ValueError):
+            return False
+        if cache.get("workspaceId") != self.workspace_id:
+            return False
+        self.projects.load(cache["projects"], cache.get("fetchedAt"))
+        if cache.get("user"):
+            self._user = cache["user"]
+        return True
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        cache = {
+            "workspaceId": self.workspace_id,
+            "fetchedAt": self.projects.fetched_at,
+            "projects": self.projects.as_dict(),
+            "user": {"id": self.user["id"]},
+        }
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            logging.warning(f"Could not cache projects: {e}")
+
+    def refresh_projects(self):
+        """
+        Fetch every project and merge any changes into the
+        registry. Returns the (added, removed) project names.
+        """
 
-    def initialize(self):
         projects = self.get_all_projects()
-        for project in projects:
-            print(project['name'])
-        self.project_ids = {proj["name"]: proj["id"] for proj in projects}
+        added, removed = self.projects.update(
+            {proj["name"]: proj["id"] for proj in projects}
+        )
+        if added or removed:
+            logging.info(f"Projects: {len(added)} added or changed, {len(removed)} removed")
+        self._save_cache()
+        return added, removed
 
-    def get_project_id(self, project):
-        return self.project_ids[project]
+    def refresh_projects_if_stale(self):
+        if self.projects.is_stale:
+            return self.refresh_projects()
+        return None
+
+    def get_project_id(self, project, refresh=False):
+        """
+        The project's id from the registry, or None if it is not
+        there. Only with `refresh` (never on the UI thread) is
+        Clockify asked, in case the registry predates the project.
+        """
+
+        if refresh and project not in self.projects and self.projects.fetched_at is not None:
+            self.refresh_projects()
+        if project not in self.projects:
+            return None
+        return self.projects.id_for(project)
 
     def _get_user(self):
-        return requests.get(
-            "https://api.clockify.me/api/v1/user",
-            headers={
-                "Content-Type": "application/json",
-                "X-Api-Key": self.api_key,
-            },
+        return self.session.get("/user").json()
+
+    def _get_projects_page(self, page):
+        return self.session.get(
+            f"/workspaces/{self.workspace_id}/projects",
+            params={"page": page, "page-size": PROJECTS_PAGE_SIZE},
         ).json()
 
     def get_all_projects(self):
-        return requests.get(
-            f"https://api.clockify.me/api/v1/workspaces/{self.workspace_id}/projects/",
-            headers={
-                "Content-Type": "application/json",
-                "X-Api-Key": self.api_key,
-            },
-        ).json()
+        """
+        Fetch every page of projects. Clockify does not say how many
+        pages there are, so they are fetched a few at a time, in
+        parallel, until a short page shows we have reached the end.
+        """
+
+        projects = []
+        page = 1
+        with ThreadPoolExecutor(max_workers=PROJECTS_CONCURRENCY) as executor:
+            while True:
+                pages = list(
+                    executor.map(
+                        self._get_projects_page,
+                        range(page, page + PROJECTS_CONCURRENCY),
+                    )
+                )
+                for results in pages:
+                    projects += results
+                    if len(results) < PROJECTS_PAGE_SIZE:
+                        return projects
+                page += PROJECTS_CONCURRENCY
 
     _user = None
 
@@ -61,75 +211,250 @@ class ClockifyTocker:
             self._user = self._get_user()
         return self._user
 
-    def stop_time_entry(self):
-        return self._stop_time_entry(self.user["id"])
+    def stop_time_entry(self, when=None, current=None):
+        return self._stop_time_entry(self.user["id"], when, current)
 
-    def _stop_time_entry(self, user_id):
-        time = datetime.datetime.utcnow().isoformat()[:-7] + "Z"
-        result = requests.patch(
-            f"https://api.clockify.me/api/v1/workspaces/{self.workspace_id}/user/{user_id}/time-entries/",
-            headers={
-                "Content-Type": "application/json",
-                "X-Api-Key": self.api_key,
-            },
-            json={"end": time},
-        ).json()
-        self.active_project_id = None
-        self.active_project = None
-        self.active_entry = None
-        self.when = datetime.datetime.utcnow()
+    def _stop_time_entry(self, user_id, when=None, current=None):
+        """
+        Stop whatever is running. The tracking state is only updated
+        if `current()`, when given, says this is still the newest
+        toggle - one made while the call was out wins.
+        """
+
+        if when is None:
+            when = datetime.datetime.utcnow()
+        time = format_time(when)
+        try:
+            result = self.session.patch(
+                f"/workspaces/{self.workspace_id}/user/{user_id}/time-entries/",
+                json={"end": time},
+            ).json()
+        except requests.exceptions.HTTPError as e:
+            # Nothing running - already stopped, perhaps by an earlier
+            # attempt whose response we never saw
+            if e.response is None or e.response.status_code != 404:
+                raise
+            result = {}
+        self._record(result)
+        with self.state_lock:
+            if current is None or current():
+                self._set_active_project_id(None)
+                self.active_entry = None
+                self.when = when
         return result
 
-    def elapsed(self):
+    def save_state(self):
+        with self.state_lock:
+            return (self.active_project_id, self.active_entry, self.when)
+
+    def restore_state(self, state):
+        with self.state_lock:
+            self.active_project_id, self.active_entry, self.when = state
+            self._set_active_project_id(self.active_project_id)
+
+    def set_local_state(self, project_id):
+        """
+        Record a start (or stop, if project_id is None) locally,
+        without waiting for Clockify to confirm it.
+        """
+
+        with self.state_lock:
+            self.when = datetime.datetime.utcnow()
+            self._set_active_project_id(project_id)
+            self.active_entry = None
+
+    def snapshot(self):
+        with self.state_lock:
+            return TrackerSnapshot.anchored(
+                self.active_project, self.active_project_id, self.active_entry, self.when
+            )
+
+    def sync(self):
+        """
+        Poll the in-progress entry once and return a snapshot of
+        the result for everything else to share.
+        """
+
         self.get_active_time_entry()
-        if not self.when:
+        return self.snapshot()
+
+    def elapsed(self, refresh=True):
+        snapshot = self.sync() if refresh else self.snapshot()
+        if not snapshot.started:
             return None, None
-        return self.active_project, datetime.datetime.utcnow() - self.when
+        return snapshot.project, snapshot.elapsed()
 
     def get_active_time_entry(self):
         return self._get_active_time_entry(self.user["id"])
 
     def _get_active_time_entry(self, user_id):
-        entry = requests.get(
-            f"https://api.clockify.me/api/v1/workspaces/{self.workspace_id}/user/{user_id}/time-entries?in-progress=true",
-            headers={
-                "Content-Type": "application/json",
-                "X-Api-Key": self.api_key,
-            },
+        entry = self.session.get(
+            f"/workspaces/{self.workspace_id}/user/{user_id}/time-entries?in-progress=true"
         ).json()
         if entry:
-            if "timeInterval" in entry[0]:
-                when = datetime.datetime.fromisoformat(
-                    entry[0]["timeInterval"]["start"].replace("T", " ")[:-1]
-                )
-                if (
-                    not self.when
-                    or when > self.when
-                    or self.active_entry == entry[0]["id"]
-                ):
-                    self.when = when
-                    if "projectId" in entry[0]:
-                        self._set_active_project_id(entry[0]["projectId"])
-            self.active_entry = entry[0]["id"]
+            with self.state_lock:
+                if "timeInterval" in entry[0]:
+                    when = datetime.datetime.fromisoformat(
+                        entry[0]["timeInterval"]["start"].replace("T", " ")[:-1]
+                    )
+                    if (
+                        not self.when
+                        or when > self.when
+                        or self.active_entry == entry[0]["id"]
+                    ):
+                        self.when = when
+                        if "projectId" in entry[0]:
+                            self._set_active_project_id(entry[0]["projectId"])
+                        self.active_entry = entry[0]["id"]
+                else:
+                    self.active_entry = entry[0]["id"]
+            self._record(entry[0])
         return entry
 
+    def get_time_entries(self, since):
+        """
+        Fetch every entry started since `since`, a page at a time.
+        """
+
+        entries = []
+        page = 1
+        while True:
+            results = self.session.get(
+                f"/workspaces/{self.workspace_id}/user/{self.user['id']}/time-entries",
+                params={"start": format_time(since), "page": page, "page-size": ENTRIES_PAGE_SIZE},
+            ).json()
+            entries += results
+            if len(results) < ENTRIES_PAGE_SIZE:
+                return entries
+            page += 1
+
+    def refresh_timesheet(self, since):
+        """
+        Bring the timesheet up to date from `since` on, including
+        dropping entries deleted in Clockify. Returns how many
+        entries were fetched.
+        """
+
+        entries = self.get_time_entries(since)
+        for entry in entries:
+            self._record(entry)
+        self.timesheet.forget_missing(since, {entry["id"] for entry in entries})
+        return len(entries)
+
+    def _record(self, entry):
+        if self.timesheet is None or not entry or "timeInterval" not in entry:
+            return
+        interval = entry["timeInterval"]
+        self.timesheet.record(
+            entry["id"],
+            entry.get("projectId"),
+            parse_time(interval["start"]),
+            parse_time(interval["end"]) if interval.get("end") else None,
+        )
+
+    def apply_webhook(self, event, payload):
+        """
+        Bring local state into line with a webhook from Clockify, as
+        a sync would, without calling back. Returns a snapshot.
+        """
+
+        if event in PROJECT_EVENTS:
+            if event == "PROJECT_DELETED" or payload.get("archived"):
+                self.projects.discard(payload["id"])
+            else:
+                self.projects.put(payload["name"], payload["id"])
+            with self.state_lock:
+                self._set_active_project_id(self.active_project_id)
+            self._save_cache()
+            return self.snapshot()
+
+        if payload.get("userId", self.user["id"]) != self.user["id"]:
+            return self.snapshot()
+
+        if event == "TIME_ENTRY_DELETED":
+            if self.timesheet is not None:
+                self.timesheet.remove(payload.get("id"))
+        else:
+            self._record(payload)
+
+        entry_id = payload.get("id")
+        interval = payload.get("timeInterval") or {}
+        with self.state_lock:
+            if event != "TIME_ENTRY_DELETED" and interval.get("start") and not interval.get("end"):
+                when = parse_time(interval["start"])
+                if not self.when or when >= self.when or self.active_entry == entry_id:
+                    self.when = when
+                    self._set_active_project_id(payload.get("projectId"))
+                    self.active_entry = entry_id
+            elif entry_id and entry_id == self.active_entry:
+                # Only our running entry - stops of older ones (e.g. by
+                # starting this one) say nothing about what is running now
+                if interval.get("end"):
+                    self.when = parse_time(interval["end"])
+                else:
+                    self.when = datetime.datetime.utcnow()
+                self._set_active_project_id(None)
+                self.active_entry = None
+        return self.snapshot()
+
     def _set_active_project_id(self, active_project_id):
         self.active_project_id = active_project_id
-        self.active_project = {v: k for k, v in self.project_ids.items()}.get(
-            self.active_project_id, None
-        )
+        self.active_project = self.projects.name_for(active_project_id)
 
-    def start_time_entry(self, detail, project_id):
-        self.when = datetime.datetime.utcnow()
-        self._set_active_project_id(project_id)
-        time = self.when.isoformat()[:-7] + "Z"
-        entry = requests.post(
-            f"https://api.clockify.me/api/v1/workspaces/{self.workspace_id}/time-entries/",
-            headers={
-                "Content-Type": "application/json",
-                "X-Api-Key": self.api_key,
-            },
+    def is_applied(self, project_id, when):
+        """
+        Whether a start (or stop, if project_id is None) at `when`
+        is already reflected in Clockify, so a retried toggle can
+        be skipped rather than creating a duplicate entry.
+        """
+
+        entry = self.get_active_time_entry()
+        if not entry:
+            return project_id is None
+        start = entry[0].get("timeInterval", {}).get("start")
+        if project_id is None:
+            return bool(start) and start > format_time(when)
+        return entry[0].get("projectId") == project_id and start == format_time(when)
+
+    def discard_time_entry(self, entry_id):
+        """
+        Delete an entry outright, for one superseded moments after
+        it was started, rather than leave it behind nearly empty.
+        """
+
+        try:
+            self.session.delete(f"/workspaces/{self.workspace_id}/time-entries/{entry_id}")
+        except requests.exceptions.HTTPError as e:
+            # Already gone, perhaps by an earlier attempt
+            if e.response is None or e.response.status_code != 404:
+                raise
+        with self.state_lock:
+            if self.active_entry == entry_id:
+                self.active_entry = None
+        if self.timesheet is not None:
+            self.timesheet.remove(entry_id)
+
+    def start_time_entry(self, detail, project_id, when=None, current=None):
+        """
+        Start an entry. As with stopping, the tracking state is only
+        updated if `current()`, when given, says nothing newer has
+        been toggled in the meantime.
+        """
+
+        if when is None:
+            when = datetime.datetime.utcnow()
+        time = format_time(when)
+        entry = self.session.post(
+            f"/workspaces/{self.workspace_id}/time-entries/",
             json={"description": detail, "projectId": project_id, "start": time},
         ).json()
-        self.active_entry = entry["id"]
+        with self.state_lock:
+            if current is None or current():
+                self.when = when
+                self._set_active_project_id(project_id)
+                self.active_entry = entry["id"]
+        if self.timesheet is not None:
+            # Clockify stopped whatever was running before
+            self.timesheet.close_open(when, keep=entry["id"])
+        self._record(entry)
         return entry
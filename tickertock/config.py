@@ -1,5 +1,8 @@
-from xdg import xdg_config_home
+from xdg import xdg_cache_home, xdg_config_home, xdg_data_home, xdg_runtime_dir
 
 CONFIG_DIR = xdg_config_home() / "tickertock"
 STREAMDECK_IMAGE_DIR = CONFIG_DIR / "assets"
+CACHE_DIR = xdg_cache_home() / "tickertock"
+DATA_DIR = xdg_data_home() / "tickertock"
+CONTROL_SOCKET = (xdg_runtime_dir() or CACHE_DIR) / "tickertock" / "control.sock"
 DECK_BUTTON_SIZE = 128
@@ -0,0 +1,111 @@
+"""
+Local control socket, so CLI commands can hand off to a running
+`tickertock ui` instead of starting from scratch and keeping their
+own, soon out-of-date, idea of what is being tracked.
+
+The protocol is one line of JSON each way, e.g.
+{"command": "toggle", "project": "Accounts"} -> {"ok": true, ...}
+"""
+
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+
+from .config import CONTROL_SOCKET
+
+CONTROL_COMMANDS = ("toggle", "stop", "status", "stats")
+CLIENT_TIMEOUT = 5
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if request.get("command") not in CONTROL_COMMANDS:
+                raise ValueError(f"Unknown command {request.get('command')}")
+            response = self.server.dispatch(request)
+        except Exception as e:
+            logging.error(f"Control request failed: {e}")
+            response = {"ok": False, "error": str(e)}
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer:
+    """
+    Listens on the control socket on a background thread, passing
+    each request to `dispatch(request) -> response`. The dispatcher
+    is called on the server thread, so must be thread-safe.
+    """
+
+    def __init__(self, dispatch, path=CONTROL_SOCKET):
+        self.path = path
+        self.dispatch = dispatch
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True, mode=0o700)
+        if self.path.exists():
+            try:
+                answered = send_command({"command": "status"}, path=self.path) is not None
+            except (OSError, ValueError) as e:
+                # Hung or not speaking our protocol - as good as stale
+                logging.warning(f"Control socket did not answer ({e}), replacing it")
+                answered = False
+            if answered:
+                logging.warning("Another tickertock is already listening, not taking over")
+                return False
+            # Left over from a process that did not exit cleanly
+            self.path.unlink()
+
+        # Created owner-only, rather than chmod-ed after binding,
+        # so it is never reachable by anyone else
+        umask = os.umask(0o077)
+        try:
+            self._server = _ControlServer(str(self.path), _ControlHandler)
+        finally:
+            os.umask(umask)
+        self._server.dispatch = self.dispatch
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="tickertock-control", daemon=True
+        )
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+        self._server = None
+
+
+def send_command(request, path=CONTROL_SOCKET, timeout=CLIENT_TIMEOUT):
+    """
+    Send a request to a running tickertock. Returns its response,
+    or None if nothing is listening.
+    """
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(str(path))
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as reply:
+                line = reply.readline()
+    except (FileNotFoundError, ConnectionRefusedError):
+        return None
+    if not line:
+        return None
+    return json.loads(line)
@@ -0,0 +1,221 @@
+"""
+Generation of the streamdeck_ui button configuration for each deck.
+
+The shipped layout is built directly as dicts. If the user has
+customized streamdeck_ui.json.j2, that is compiled once and used
+instead. Either way, a layout is only built once for each distinct
+deck size and project list, and shared between matching decks.
+"""
+
+import json
+import hashlib
+import pathlib
+from collections import OrderedDict
+
+from .config import CONFIG_DIR, STREAMDECK_IMAGE_DIR
+from .pages import INITIAL_PAGES
+
+SKEL_TEMPLATE = pathlib.Path(__file__).parent / "skel" / "streamdeck_ui.json.j2"
+LAYOUT_CACHE_SIZE = 8
+
+_layouts = OrderedDict()
+_template = None
+
+
+def _user_template():
+    """
+    The user's template, compiled once, or None if they are
+    still using the shipped one (or have none).
+    """
+
+    global _template
+
+    path = CONFIG_DIR / "streamdeck_ui.json.j2"
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+
+    key = (stat.st_mtime_ns, stat.st_size)
+    if _template is None or _template[0] != key:
+        source = path.read_text()
+        if source == SKEL_TEMPLATE.read_text():
+            _template = (key, None)
+        else:
+            from jinja2 import Environment, select_autoescape, FileSystemLoader
+
+            env = Environment(
+                loader=FileSystemLoader(CONFIG_DIR), autoescape=select_autoescape()
+            )
+            _template = (key, env.get_template("streamdeck_ui.json.j2"))
+    return _template[1]
+
+
+def _paginate(tickertock, buttons):
+    # The last key on each page is reserved for the status/paging button
+    per_page = buttons - 1
+    items = tickertock.entries
+    pages = [
+        {"entries": {code: tickertock.projects[code] for code in items[i : i + per_page]}}
+        for i in range(0, len(items), per_page)
+    ]
+    return pages or [{"entries": {}}]
+
+
+def _build_layout(pages, buttons):
+    """
+    Direct equivalent of the shipped streamdeck_ui.json.j2.
+    Page 0 duplicates page 1, to act as the "home" page showing
+    what is running.
+    """
+
+    layout = {}
+    for p, page in enumerate([pages[0]] + pages):
+        keys = {}
+        for n, (code, project) in enumerate(list(page["entries"].items())[: buttons - 1]):
+            button = {"write": ""}
+            if isinstance(project.get("image", None), str):
+                button["icon"] = project["image"]
+            button["text"] = code
+            button["keys"] = ""
+            keys[n] = button
+        if p == 0:
+            keys[buttons - 1] = {"write": "", "icon": "", "text": "NOT RUN", "keys": ""}
+        else:
+            keys[buttons - 1] = {
+                "command": "",
+                "write": "",
+                "text": "NOT RUN",
+                "icon": f"{STREAMDECK_IMAGE_DIR}/paused.png",
+            }
+        layout[p] = keys
+    return {"buttons": layout, "brightness": 99, "page": 1}
+
+
+def _render_template(template, pages, buttons):
+    inset = json.loads(
+        template.render(
+            len=len,
+            enumerate=enumerate,
+            isinstance=isinstance,
+            streamdeck_image_dir=STREAMDECK_IMAGE_DIR,
+            str=str,
+            list=list,
+            pages=pages,
+            buttons=buttons,
+        )
+    )
+    inset["buttons"] = {
+        int(page_id): {int(button_id): button for button_id, button in page.items()}
+        for page_id, page in inset["buttons"].items()
+    }
+    return inset
+
+
+def _projects_key(tickertock):
+    digest = hashlib.sha256()
+    for code in tickertock.entries:
+        project = tickertock.projects.get(code, {})
+        image = project.get("image")
+        # In-memory images are compared by what was drawn (see
+        # frames.KeyFrame), without importing PIL just for that
+        if not isinstance(image, str):
+            image = getattr(image, "key", None) or id(image)
+        digest.update(f"{code}\0{project.get('name')}\0{image}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def deck_layout(tickertock, buttons):
+    """
+    Button configuration for a deck with this many keys, memoized
+    on the layout, entries and projects. The result is shared, so
+    must be copied before being handed to a deck. Colour tiles are
+    left to page_buttons.
+    """
+
+    template = _user_template()
+    key = (
+        buttons,
+        id(template),
+        tuple(tickertock.entries),
+        _projects_key(tickertock),
+    )
+    if key in _layouts:
+        _layouts.move_to_end(key)
+        return _layouts[key]
+
+    pages = _paginate(tickertock, buttons)
+    if template is None:
+        layout = _build_layout(pages, buttons)
+    else:
+        layout = _render_template(template, pages, buttons)
+
+    _layouts[key] = layout
+    while len(_layouts) > LAYOUT_CACHE_SIZE:
+        _layouts.popitem(last=False)
+    return layout
+
+
+def _copy_layout(layout):
+    copied = dict(layout)
+    copied["buttons"] = {
+        page_id: {button_id: dict(button) for button_id, button in page.items()}
+        for page_id, page in layout["buttons"].items()
+    }
+    return copied
+
+
+def page_buttons(tickertock, buttons, page):
+    """
+    One page of a deck's buttons, with project images, drawing any
+    that are not drawn yet. The copy is the caller's.
+    """
+
+    layout = deck_layout(tickertock, buttons)
+    keys = {
+        button: dict(settings)
+        for button, settings in layout["buttons"].get(page, {}).items()
+    }
+    images = tickertock.project_images(
+        [settings["text"] for settings in keys.values() if "text" in settings]
+    )
+    for settings in keys.values():
+        if settings.get("text") in images:
+            settings["icon"] = images[settings["text"]]
+    return keys
+
+
+def deck_state(tickertock, buttons, with_images=False):
+    """
+    A deck's own copy of its layout, safe to change. With images,
+    only the first pages are built - the rest are left empty, but
+    present, for the application to build when they are shown.
+    """
+
+    if not with_images:
+        return _copy_layout(deck_layout(tickertock, buttons))
+
+    state = dict(deck_layout(tickertock, buttons))
+    state["buttons"] = {
+        page: page_buttons(tickertock, buttons, page) if page in INITIAL_PAGES else {}
+        for page in state["buttons"]
+    }
+    return state
+
+
+def merge_streamdeck_config(tickertock, streamdeck_input, get_deck, with_images=False):
+    for device, deck in streamdeck_input["state"].items():
+        try:
+            deck = get_deck(device)
+            layout = deck["layout"]
+            buttons = layout[0] * layout[1]
+        except Exception as e:
+            print(e)
+            buttons = len(list(deck["buttons"].values())[0])
+
+        streamdeck_input["state"][device] = deck_state(
+            tickertock, buttons, with_images=with_images
+        )
+
+    streamdeck_input["streamdeck_ui_version"] = 1
+    return streamdeck_input
@@ -0,0 +1,193 @@
+"""
+Button images on their way to the decks. Frames we draw stay as
+pixels rather than PNGs, and are converted straight to each deck
+model's native format, with the encoded bytes cached, so a clock
+tick or page switch pushes bytes that are already made.
+"""
+
+import sys
+import logging
+import threading
+from io import BytesIO
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+from StreamDeck.ImageHelpers import PILHelper
+
+from .metrics import METRICS
+
+NATIVE_CACHE_SIZE = 1024
+FONT_SIZE = 14
+
+# How cairo's native-endian ARGB32 is laid out in memory
+_CAIRO_RAWMODE = "BGRa" if sys.byteorder == "little" else None
+
+
+class KeyFrame:
+    """
+    A drawn button image. `key` says what was drawn - equal keys
+    are the same picture, which is what encoded frames are cached
+    on. It is only turned into a PNG if something (the tray, a disk
+    cache) asks for one with `getvalue()`, as with a BytesIO.
+    """
+
+    def __init__(self, key, image=None, png=None):
+        self.key = key
+        self._image = image
+        self._png = png
+
+    @classmethod
+    def from_surface(cls, key, surface):
+        """
+        Take the pixels straight out of a cairo ImageSurface.
+        """
+
+        if _CAIRO_RAWMODE is None:
+            buffer = BytesIO()
+            surface.write_to_png(buffer)
+            return cls(key, png=buffer.getvalue())
+
+        surface.flush()
+        size = (surface.get_width(), surface.get_height())
+        image = Image.frombuffer(
+            "RGBA", size, surface.get_data(), "raw", _CAIRO_RAWMODE, surface.get_stride(), 1
+        )
+        return cls(key, image=image)
+
+    def __eq__(self, other):
+        return isinstance(other, KeyFrame) and other.key == self.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    @property
+    def size(self):
+        return self.image().size
+
+    def image(self):
+        """
+        The pixels, as an RGBA PIL image - shared, so not to be
+        drawn on.
+        """
+
+        if self._image is None:
+            image = Image.open(BytesIO(self._png))
+            self._image = image.convert("RGBA")
+        return self._image
+
+    def cairo_data(self):
+        """
+        The pixels laid out as a cairo ARGB32 surface's (so with a
+        stride of four bytes a pixel), or None if we do not know
+        how on this machine.
+        """
+
+        if _CAIRO_RAWMODE is None:
+            return None
+        return bytearray(self.image().tobytes("raw", _CAIRO_RAWMODE))
+
+    def getvalue(self):
+        if self._png is None:
+            buffer = BytesIO()
+            self._image.save(buffer, "PNG")
+            self._png = buffer.getvalue()
+        return self._png
+
+
+def frame_key(icon):
+    """
+    What identifies an icon's pixels, or None if nothing does.
+    """
+
+    if isinstance(icon, str):
+        return ("file", icon)
+    return getattr(icon, "key", None)
+
+
+def load_font(size=FONT_SIZE):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow before 10.1 only has the fixed bitmap font
+        return ImageFont.load_default()
+
+
+def compose_key(size, icon, text, font=None):
+    """
+    A key image: the icon (a KeyFrame or PNG path), if any, with the
+    text along the bottom - or in the middle, without an icon - as
+    streamdeck_ui draws them.
+    """
+
+    image = Image.new("RGB", size, "black")
+    if icon:
+        try:
+            if isinstance(icon, KeyFrame):
+                source = icon.image()
+            else:
+                source = Image.open(icon).convert("RGBA")
+            if source.size != tuple(size):
+                source = source.resize(size)
+            image.paste(source, (0, 0), source)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not draw {icon}: {e}")
+            icon = None
+
+    if text:
+        draw = ImageDraw.Draw(image)
+        font = font or load_font()
+        if icon:
+            position, anchor = (size[0] / 2, size[1] - 2), "md"
+        else:
+            position, anchor = (size[0] / 2, size[1] / 2), "mm"
+        draw.text(position, text, font=font, anchor=anchor, fill="white")
+
+    return image
+
+
+class NativeFrameCache:
+    """
+    Bounded LRU of key images already in a deck model's native
+    format (flipped, rotated and JPEG or BMP encoded), keyed by the
+    model, the icon and the text. Decks of the same model share
+    frames, and every clockface only has to be encoded once.
+    """
+
+    def __init__(self, maxsize=NATIVE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, deck, icon, text, font=None):
+        icon_key = frame_key(icon)
+        if icon and icon_key is None:
+            # Nothing to tell one buffer's pixels from another's by
+            return self._encode(deck, icon, text, font)
+
+        key = (deck.deck_type(), icon_key, text)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+                METRICS.inc("tickertock_native_frame_cache_total", result="hit")
+                return frame
+
+        METRICS.inc("tickertock_native_frame_cache_total", result="miss")
+        frame = self._encode(deck, icon, text, font)
+        with self._lock:
+            self._frames[key] = frame
+            while len(self._frames) > self.maxsize:
+                self._frames.popitem(last=False)
+        return frame
+
+    @METRICS.timed("tickertock_render_seconds", kind="native")
+    def _encode(self, deck, icon, text, font):
+        size = deck.key_image_format()["size"]
+        return PILHelper.to_native_key_format(deck, compose_key(size, icon, text, font))
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+
+NATIVE_FRAMES = NativeFrameCache()
@@ -0,0 +1,185 @@
+"""
+Headless deck driver, for always-on machines with no desktop to
+speak of. It drives the decks directly through the StreamDeck
+library, with its own small event loop, so neither Qt (PySide6) nor
+streamdeck_ui are loaded. There is no tray or settings window, but
+toggling, paging, the clock and totals all work as in the UI.
+"""
+
+import signal
+import logging
+from functools import partial
+
+from StreamDeck.DeviceManager import DeviceManager
+
+from .application import DeckApplication
+from .deckconfig import deck_state
+from .frames import NATIVE_FRAMES, load_font
+from .loop import EventLoop, LoopTimer
+
+# How often to look for decks being plugged in or out
+DISCOVERY_INTERVAL_MS = 5000
+
+
+class HeadlessDeckServer:
+    """
+    Keeps each deck's buttons and page, with the same methods as the
+    parts of TickertockStreamDeckServer that the application uses,
+    and pushes images for whatever is on the current page.
+
+    Only used from the loop thread - key presses from the library's
+    own thread are passed to `on_key`, which must queue them.
+    """
+
+    def __init__(self, tickertock, on_key):
+        self.tickertock = tickertock
+        self.on_key = on_key
+        self.decks = {}
+        self.state = {}
+        # What each key is showing, to skip pushing it again
+        self._shown = {}
+        self._font = load_font()
+
+    def attach(self, deck):
+        deck.open()
+        deck.reset()
+        serial = deck.get_serial_number()
+        rows, cols = deck.key_layout()
+        self.decks[serial] = deck
+        self._shown[serial] = {}
+        self.state[serial] = deck_state(self.tickertock, rows * cols, with_images=True)
+        deck.set_brightness(self.state[serial].get("brightness", 99))
+        deck.set_key_callback(lambda _, key, pressed: self.on_key(serial, key, pressed))
+        self.render_page(serial)
+        logging.info(f"Attached {deck.deck_type()} {serial}")
+
+    def detach(self, serial):
+        deck = self.decks.pop(serial)
+        self.state.pop(serial, None)
+        self._shown.pop(serial, None)
+        try:
+            deck.close()
+        except Exception as e:
+            logging.debug(f"Could not close {serial}: {e}")
+        logging.info(f"Detached {serial}")
+
+    def scan(self, devices):
+        """
+        Attach any new visual decks among `devices`, and drop any
+        that have gone.
+        """
+
+        for serial, deck in list(self.decks.items()):
+            if not deck.connected():
+                self.detach(serial)
+
+        attached = {deck.id() for deck in self.decks.values()}
+        for deck in devices:
+            if deck.is_visual() and deck.id() not in attached:
+                try:
+                    self.attach(deck)
+                except Exception as e:
+                    logging.error(f"Could not attach deck: {e}")
+
+    def get_deck(self, serial):
+        deck = self.decks[serial]
+        return {
+            "id": deck.id(),
+            "type": deck.deck_type(),
+            "layout": deck.key_layout(),
+            "visual": deck.is_visual(),
+        }
+
+    def get_page(self, serial):
+        return self.state[serial].get("page", 0)
+
+    def _button(self, serial, page, button):
+        return self.state[serial]["buttons"].setdefault(page, {}).setdefault(button, {})
+
+    def apply_updates(self, serial, page, buttons):
+        """
+        Make a batch of button changes, {(page, button): settings},
+        and switch page, if given, pushing each key at most once.
+        """
+
+        for (button_page, button), settings in buttons.items():
+            self._button(serial, button_page, button).update(settings)
+        if page is not None:
+            self.state[serial]["page"] = page
+            self.render_page(serial)
+            return
+        current = self.get_page(serial)
+        for button_page, button in buttons:
+            if button_page == current:
+                self.render_key(serial, button)
+
+    def render_key(self, serial, key):
+        deck = self.decks[serial]
+        settings = self.state[serial]["buttons"].get(self.get_page(serial), {}).get(key, {})
+        image = NATIVE_FRAMES.get(deck, settings.get("icon"), settings.get("text"), self._font)
+        if self._shown[serial].get(key) == image:
+            return
+        with deck:
+            deck.set_key_image(key, image)
+        self._shown[serial][key] = image
+
+    def render_page(self, serial):
+        for key in range(self.decks[serial].key_count()):
+            self.render_key(serial, key)
+
+    def close(self):
+        for serial in list(self.decks):
+            deck = self.decks[serial]
+            with deck:
+                deck.reset()
+            self.detach(serial)
+
+
+class HeadlessApplication(DeckApplication):
+    """
+    The deck application on its own event loop, with no Qt. Without
+    D-Bus, sleeps are noticed from the clock rather than announced.
+    """
+
+    def __init__(self, tickertock, device_manager=None):
+        super().__init__(tickertock)
+        self.loop = EventLoop()
+        self.device_manager = device_manager
+        self.api = HeadlessDeckServer(
+            tickertock, partial(self.loop.invoke, self.handle_keypress_additional)
+        )
+
+    def make_timer(self, callback, single_shot=True, precise=False):
+        return LoopTimer(self.loop, callback, single_shot)
+
+    def discover(self):
+        if self.device_manager is None:
+            self.device_manager = DeviceManager()
+        try:
+            devices = self.device_manager.enumerate()
+        except Exception as e:
+            logging.error(f"Could not look for decks: {e}")
+            return
+        self.api.scan(devices)
+
+    def run(self):
+        self.start_worker(self.loop.invoke)
+
+        self.discover()
+        if not self.api.decks:
+            logging.warning("No decks found yet - will keep looking")
+        self.discovery_timer = self.make_timer(self.discover, single_shot=False)
+        self.discovery_timer.start(DISCOVERY_INTERVAL_MS)
+
+        self.start_services(self.loop.invoke, self.loop.call)
+
+        # Stop cleanly on SIGTERM (e.g. from systemd) as on Ctrl-C
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop_services()
+            self.api.close()
+        return 0
@@ -0,0 +1,110 @@
+"""
+Write-ahead journal of toggles, so time is never lost when the
+timetracking API cannot be reached. Every toggle is written here
+first, with its local timestamp, and replayed to the tocker in
+order afterwards.
+"""
+
+import sqlite3
+import datetime
+import threading
+from collections import namedtuple
+
+JournalEvent = namedtuple(
+    "JournalEvent", ["id", "project", "project_id", "at", "attempts"]
+)
+
+# `sent` is 0 while pending, 1 once sent and FAILED if the tocker
+# turned it down
+FAILED = -1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project TEXT NOT NULL,
+    project_id TEXT,
+    at TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    entry_id TEXT
+)
+"""
+
+
+class ToggleJournal:
+    """
+    Append-only SQLite log of start/stop events. Times are kept
+    as naive UTC ISO strings, the same as the tockers use.
+    """
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(SCHEMA)
+
+    def append(self, project, project_id, at=None):
+        if at is None:
+            at = datetime.datetime.utcnow()
+        with self._lock, self._db:
+            cursor = self._db.execute(
+                "INSERT INTO events (project, project_id, at) VALUES (?, ?, ?)",
+                (project, project_id, at.isoformat()),
+            )
+        return JournalEvent(cursor.lastrowid, project, project_id, at, 0)
+
+    def pending(self, limit=None):
+        query = "SELECT id, project, project_id, at, attempts FROM events WHERE sent = 0 ORDER BY id"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._db.execute(query).fetchall()
+        return [
+            JournalEvent(
+                row[0], row[1], row[2], datetime.datetime.fromisoformat(row[3]), row[4]
+            )
+            for row in rows
+        ]
+
+    def latest_id(self):
+        with self._lock:
+            return self._db.execute("SELECT MAX(id) FROM events").fetchone()[0]
+
+    def pending_count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM events WHERE sent = 0").fetchone()[0]
+
+    def mark_attempt(self, event):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE events SET attempts = attempts + 1 WHERE id = ?", (event.id,)
+            )
+
+    def mark_sent(self, event, entry_id=None):
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE events SET sent = 1, entry_id = ? WHERE id = ?",
+                (entry_id, event.id),
+            )
+
+    def mark_failed(self, event):
+        with self._lock, self._db:
+            self._db.execute("UPDATE events SET sent = ? WHERE id = ?", (FAILED, event.id))
+
+    def prune(self, keep_days=30):
+        """
+        Drop sent (or failed) events older than keep_days, so the
+        journal does not grow forever.
+        """
+
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=keep_days)
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM events WHERE sent != 0 AND at < ?", (cutoff.isoformat(),)
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
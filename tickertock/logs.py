@@ -0,0 +1,154 @@
+"""
+Logging to `settoggl.log` without ever waiting on the disk: records
+go onto a bounded queue and a background thread writes them, as
+JSON lines, rotating the file when it gets too big or too old. If
+the writer falls behind, records are dropped rather than queued
+without end. Only the standard library is used, so `toggle` stays
+quick to start.
+"""
+
+import json
+import queue
+import atexit
+import logging
+import datetime
+import logging.handlers
+
+from xdg import xdg_cache_home
+
+LOG_PATH = xdg_cache_home() / "settoggl.log"
+LOG_MAX_BYTES = 1024 * 1024
+LOG_MAX_AGE_S = 7 * 24 * 3600
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 1000
+
+# Everything a LogRecord has anyway - the rest came in as `extra`
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger and message, then
+    any `extra` fields (such as `latency_ms`) as they were given.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_FIELDS and not name.startswith("_"):
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class RotatingLogHandler(logging.handlers.RotatingFileHandler):
+    """
+    Rotates on size, like its parent, and also once the current file
+    was started more than `max_age` seconds ago - going by its first
+    record, as the CLI opens the file afresh each run. A file that
+    does not start with a JSON record (from before) is rotated out
+    straight away, so the current one is always JSON lines.
+    """
+
+    def __init__(self, filename, max_bytes, max_age, backup_count):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.max_age = max_age
+        self._started = None
+
+    def _file_started(self):
+        try:
+            with open(self.baseFilename, "rb") as f:
+                first = f.readline()
+        except OSError:
+            return None
+        if not first:
+            return None
+        try:
+            started = json.loads(first)["time"]
+            return datetime.datetime.fromisoformat(started).timestamp()
+        except (ValueError, KeyError, TypeError):
+            return 0
+
+    def shouldRollover(self, record):
+        if self.stream is None and self._started is None:
+            self._started = self._file_started()
+        if self._started is None:
+            self._started = record.created
+        if record.created - self._started >= self.max_age:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._started = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue without blocking, dropping them
+    if it is full, and says how many went once there is room again.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord(
+                        {
+                            "name": "tickertock.logs",
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": f"Dropped {self.dropped} log records - writer falling behind",
+                            "dropped": self.dropped,
+                        }
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """
+    The background thread writing queued records out. Stopping it
+    waits for room to queue the end marker, rather than failing when
+    the queue is full, so everything queued is written at exit.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(level=logging.INFO, path=LOG_PATH):
+    """
+    Send the root logger's records through the queue to the log file,
+    returning the listener, which is stopped (and the queue written
+    out) at exit.
+    """
+
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    writer = RotatingLogHandler(path, LOG_MAX_BYTES, LOG_MAX_AGE_S, LOG_BACKUP_COUNT)
+    writer.setFormatter(JSONFormatter())
+    listener = LogWriter(records, writer)
+
+    root = logging.getLogger()
+    root.addHandler(DroppingQueueHandler(records))
+    root.setLevel(level)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
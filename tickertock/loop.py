@@ -0,0 +1,128 @@
+"""
+A small single-threaded event loop - calls queued from any thread,
+plus timers - standing in for Qt's in headless mode.
+"""
+
+import time
+import heapq
+import queue
+import logging
+import itertools
+
+from .control import CLIENT_TIMEOUT
+
+
+class EventLoop:
+    """
+    Runs queued calls and due timers, one at a time, on whichever
+    thread calls `run()`, sleeping in between.
+    """
+
+    def __init__(self):
+        self._calls = queue.Queue()
+        self._timers = []
+        self._order = itertools.count()
+        self._running = False
+
+    def invoke(self, function, *args):
+        """
+        Queue a call - safe from any thread.
+        """
+
+        self._calls.put((function, args))
+
+    def call(self, function, *args, timeout=CLIENT_TIMEOUT):
+        """
+        Run function on the loop and wait for its result.
+        """
+
+        reply = queue.Queue(maxsize=1)
+
+        def run(*args):
+            try:
+                reply.put((function(*args), None))
+            except Exception as e:
+                reply.put((None, e))
+
+        self.invoke(run, *args)
+        result, error = reply.get(timeout=timeout)
+        if error:
+            raise error
+        return result
+
+    def _schedule(self, timer, due):
+        # Only touched from the loop thread, like Qt's timers
+        heapq.heappush(self._timers, (due, next(self._order), timer, timer._generation))
+
+    def _run_due(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, timer, generation = heapq.heappop(self._timers)
+            if generation == timer._generation:
+                try:
+                    timer._fire()
+                except Exception:
+                    # Carry on, as Qt does after an error in a slot
+                    logging.exception("Error in timer callback")
+
+    def run(self):
+        self._running = True
+        while self._running:
+            self._run_due()
+            timeout = None
+            if self._timers:
+                timeout = max(0, self._timers[0][0] - time.monotonic())
+            try:
+                function, args = self._calls.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            try:
+                function(*args)
+            except Exception:
+                logging.exception(f"Error in {getattr(function, '__name__', function)}")
+
+    def stop(self):
+        """
+        Stop once the current call is done - safe from any thread.
+        """
+
+        def stop():
+            self._running = False
+
+        self.invoke(stop)
+
+
+class LoopTimer:
+    """
+    The parts of QTimer the deck application uses.
+    """
+
+    def __init__(self, loop, callback, single_shot=True):
+        self.loop = loop
+        self.callback = callback
+        self.single_shot = single_shot
+        self.interval = 0
+        self._generation = 0
+        self._active = False
+
+    def start(self, msec=None):
+        if msec is not None:
+            self.interval = msec
+        self._generation += 1
+        self._active = True
+        self.loop._schedule(self, time.monotonic() + self.interval / 1000)
+
+    def stop(self):
+        # Anything already scheduled is ignored once this changes
+        self._generation += 1
+        self._active = False
+
+    def isActive(self):
+        return self._active
+
+    def _fire(self):
+        if self.single_shot:
+            self._active = False
+        else:
+            self.start()
+        self.callback()
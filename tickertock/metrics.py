@@ -0,0 +1,150 @@
+"""
+In-memory runtime metrics - counters and latency histograms - for
+the hot paths: API requests, sync ticks, image renders and
+keypresses. They can be written out in Prometheus text format, to
+a file or a local HTTP endpoint, and are shown by `tickertock stats`.
+"""
+
+import os
+import time
+import bisect
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .config import CACHE_DIR
+
+# Where the UI leaves its metrics, for `tickertock stats` and
+# node_exporter's textfile collector
+METRICS_PATH = CACHE_DIR / "metrics.prom"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{value}"' for key, value in sorted(labels))
+    return f"{{{pairs}}}"
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, each keyed
+    by name and a set of labels.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Per-bucket counts (last is +Inf), then sum
+                histogram = self._histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            histogram[0][bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[1] += seconds
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, **labels):
+        """
+        Decorator version of timer.
+        """
+
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def render(self):
+        """
+        Everything collected so far, in Prometheus text format.
+        """
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                (key, (list(counts), total)) for key, (counts, total) in self._histograms.items()
+            )
+
+        lines = []
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), (counts, total) in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                bucket = labels + (("le", bound),)
+                lines.append(f"{name}_bucket{_labels(bucket)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """
+        Expose the metrics for Prometheus to scrape, on a background
+        thread. Returns the server, so it can be shut down.
+        """
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(
+            target=server.serve_forever, name="tickertock-metrics", daemon=True
+        ).start()
+        logging.info(f"Serving metrics on http://{host}:{port}/")
+        return server
+
+
+METRICS = Metrics()
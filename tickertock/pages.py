@@ -0,0 +1,57 @@
+"""
+Pages of project buttons are built when a deck is paged to them,
+rather than all up front - with hundreds of projects, most pages
+are never looked at. The pages either side of the one shown are
+drawn in the background, and only the most recently shown stay
+built.
+"""
+
+from collections import OrderedDict
+
+# Built into each deck's state when it attaches (see deck_state)
+INITIAL_PAGES = (0, 1)
+RESIDENT_PAGES = 4
+
+
+class DeckPages:
+    """
+    The order each deck's pages were last shown in, to pick which
+    to drop once more than `resident` are built. Page 0, the home
+    page, is always kept.
+    """
+
+    def __init__(self, resident=RESIDENT_PAGES):
+        self.resident = max(resident, len(INITIAL_PAGES))
+        self._shown = {}
+
+    def show(self, deck_id, page):
+        """
+        Note that `page` is being shown, returning any pages that
+        should be dropped to make room.
+        """
+
+        pages = self._shown.setdefault(deck_id, OrderedDict.fromkeys(INITIAL_PAGES))
+        pages[page] = None
+        pages.move_to_end(page)
+
+        dropped = []
+        for old in list(pages):
+            if len(pages) <= self.resident:
+                break
+            if old not in (0, page):
+                del pages[old]
+                dropped.append(old)
+        return dropped
+
+    @staticmethod
+    def neighbours(page, page_count):
+        """
+        Pages that paging on or back from `page` would show.
+        """
+
+        if page_count < 2:
+            return []
+        last = page_count - 1
+        if page == 0:
+            return sorted({1, min(last, 2)})
+        return sorted({page % last + 1, (page - 2) % last + 1} - {page})
@@ -0,0 +1,81 @@
+import time
+import threading
+
+
+class ProjectRegistry:
+    """
+    Two-way index of project names and ids, with a note of
+    when it was last refreshed so it can go stale after `ttl`
+    seconds and be refreshed in the background.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.fetched_at = None
+        self._ids = {}
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, name):
+        return name in self._ids
+
+    @property
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at > self.ttl
+
+    def id_for(self, name):
+        return self._ids[name]
+
+    def name_for(self, project_id, default=None):
+        return self._names.get(project_id, default)
+
+    def as_dict(self):
+        return dict(self._ids)
+
+    def load(self, ids, fetched_at=None):
+        """
+        Replace the index wholesale, e.g. from a cache.
+        """
+
+        with self._lock:
+            self._ids = dict(ids)
+            self._names = {v: k for k, v in self._ids.items()}
+            self.fetched_at = fetched_at
+
+    def put(self, name, project_id):
+        """
+        Add or rename a single project, as reported by a webhook.
+        """
+
+        with self._lock:
+            self._ids.pop(self._names.pop(project_id, None), None)
+            if name in self._ids:
+                self._names.pop(self._ids[name], None)
+            self._ids[name] = project_id
+            self._names[project_id] = name
+
+    def discard(self, project_id):
+        with self._lock:
+            self._ids.pop(self._names.pop(project_id, None), None)
+
+    def update(self, ids):
+        """
+        Merge a freshly fetched name -> id map, touching only the
+        entries that changed. Returns (added, removed) names.
+        """
+
+        with self._lock:
+            added = {name for name, pid in ids.items() if self._ids.get(name) != pid}
+            removed = set(self._ids) - set(ids)
+            for name in removed:
+                self._names.pop(self._ids.pop(name), None)
+            for name in added:
+                if name in self._ids:
+                    self._names.pop(self._ids[name], None)
+                self._ids[name] = ids[name]
+                self._names[ids[name]] = name
+            self.fetched_at = time.time()
+        return added, removed
@@ -0,0 +1,122 @@
+"""
+Decides when to next poll the tocker, instead of polling at a
+fixed rate. It polls quickly for a little while after a local
+toggle, backs off exponentially while nothing changes or calls
+fail, waits out rate limits and stops while nobody is there.
+"""
+
+import time
+
+# Seconds
+FAST_INTERVAL = 5.0
+FAST_WINDOW = 60.0
+MAX_INTERVAL = 600.0
+# More time than this passing while suspended counts as a sleep
+WAKE_THRESHOLD = 5.0
+
+_CLOCK_BOOTTIME = getattr(time, "CLOCK_BOOTTIME", None)
+
+
+def _suspended_time():
+    """
+    Total time spent suspended since boot, where the OS can tell us.
+    """
+
+    if _CLOCK_BOOTTIME is None:
+        return 0.0
+    return time.clock_gettime(_CLOCK_BOOTTIME) - time.monotonic()
+
+
+class SyncScheduler:
+    """
+    Bookkeeping only, with no timers of its own: the caller asks
+    `next_delay()` how long to wait, and reports back each sync
+    with `synced()`. Times are in seconds.
+    """
+
+    def __init__(
+        self,
+        interval,
+        max_interval=MAX_INTERVAL,
+        fast_interval=FAST_INTERVAL,
+        fast_window=FAST_WINDOW,
+    ):
+        self.fast_interval = fast_interval
+        self.fast_window = fast_window
+        self.paused = False
+        self.failures = 0
+        self._fast_until = 0.0
+        self._throttled_until = 0.0
+        self._suspended = _suspended_time()
+        self.configure(interval, max_interval)
+
+    def configure(self, interval, max_interval=MAX_INTERVAL):
+        self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.current = interval
+
+    def toggled(self):
+        """
+        A toggle was made here, so watch closely for a while.
+        """
+
+        self._fast_until = time.monotonic() + self.fast_window
+        self.current = self.interval
+
+    def synced(self, changed, error=None, throttled_for=0.0):
+        """
+        Record how a sync went: back off while nothing is changing
+        or the tocker is failing, and snap back on any change.
+        """
+
+        if error:
+            self.failures += 1
+        else:
+            self.failures = 0
+            if changed:
+                self.current = self.interval
+            else:
+                self.current = min(self.current * 2, self.max_interval)
+
+        if throttled_for:
+            self._throttled_until = time.monotonic() + throttled_for
+
+    def next_delay(self):
+        """
+        Seconds until the next sync, or None while paused.
+        """
+
+        if self.paused:
+            return None
+
+        now = time.monotonic()
+        if self.failures:
+            delay = min(self.interval * 2**self.failures, self.max_interval)
+        elif now < self._fast_until:
+            delay = self.fast_interval
+        else:
+            delay = self.current
+        return max(delay, self._throttled_until - now)
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        """
+        Start again after a pause - the caller should sync straight
+        away, as anything could have changed meanwhile.
+        """
+
+        self.paused = False
+        self.current = self.interval
+
+    def woke(self):
+        """
+        Whether the machine has been asleep since this was last
+        asked, for when nobody told us it was going.
+        """
+
+        suspended = _suspended_time()
+        slept = suspended - self._suspended > WAKE_THRESHOLD
+        self._suspended = suspended
+        return slept
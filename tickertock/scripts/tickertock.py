@@ -1,51 +1,146 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+
+_STARTED = time.perf_counter()
+
 import shutil
 import json
 import datetime
 import logging
 import sys
 import os
-import toml
 import click
-import time
-from xdg import xdg_cache_home
 
 from tickertock.config import CONFIG_DIR
+from tickertock.logs import setup_logging
 from tickertock import __version__
-from tickertock.ui import TickertockApplication, merge_streamdeck_config, TickertockStreamDeckServer
-from tickertock.skel import initialize as skel_initialize
-from tickertock.tickertock import Tickertock
 
-logging.basicConfig(filename=xdg_cache_home() / "settoggl.log", level=logging.INFO)
+# GUI and rendering modules (PySide6, streamdeck_ui, pynput, cairo)
+# are only imported by the commands that need them, so quick
+# commands like toggle and version start fast.
+
+setup_logging()
 
 _BEAR_COMMANDS = ("init", "version")
 
+# Commands that try a running tickertock first, and only set
+# themselves up (without images) if there is none
+_CLIENT_COMMANDS = ("toggle", "status", "stats")
+
+
+def _direct():
+    from tickertock.tickertock import Tickertock
+
+    tickertock = Tickertock("clockify")
+    tickertock.initialize(with_images=False)
+    return tickertock
+
+
+def _ask_daemon(request, direct):
+    if direct:
+        return None
+    from tickertock.control import send_command
+
+    try:
+        return send_command(request)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not use running tickertock: {e}")
+        return None
+
 
 @click.group()
 @click.pass_context
 def cli(ctx):
-    if ctx.invoked_subcommand not in _BEAR_COMMANDS:
+    if ctx.invoked_subcommand not in _BEAR_COMMANDS + _CLIENT_COMMANDS:
+        from tickertock.tickertock import Tickertock
+
         ctx.obj = Tickertock("clockify")
         ctx.obj.initialize()
 
 
 @cli.command()
 @click.argument("project")
-@click.pass_obj
-def toggle(obj, project):
+@click.option("--direct", is_flag=True, help="Do not hand off to a running tickertock")
+def toggle(project, direct):
     logging.info(project)
 
-    success = obj.toggle(project)
+    if project == "None":
+        request = {"command": "stop"}
+    else:
+        request = {"command": "toggle", "project": project}
+    response = _ask_daemon(request, direct)
+    if response is not None:
+        success = response["ok"] and (project if project != "None" else True)
+        if not response["ok"]:
+            print(response.get("error"))
+    else:
+        success = _direct().toggle(project)
 
+    took = (time.perf_counter() - _STARTED) * 1000
+    logging.info(
+        f"toggle took {took:.0f}ms",
+        extra={
+            "command": "toggle",
+            "project": project,
+            "latency_ms": round(took, 1),
+            "via": "direct" if response is None else "daemon",
+        },
+    )
     return success
 
 
+@cli.command()
+@click.option("--direct", is_flag=True, help="Do not ask a running tickertock")
+def status(direct):
+    response = _ask_daemon({"command": "status"}, direct)
+    if response is None:
+        snapshot = _direct().tocker.sync()
+        elapsed = snapshot.elapsed() if snapshot.project else None
+        response = {
+            "ok": True,
+            "project": snapshot.project,
+            "elapsed": elapsed.total_seconds() if elapsed else None,
+        }
+
+    if response.get("project"):
+        print(f"@{response['project']}", f"{int(response['elapsed'] // 60)}m")
+    else:
+        print("NOT RUN")
+
+
+@cli.command()
+@click.option("--direct", is_flag=True, help="Read the last metrics written, rather than asking")
+def stats(direct):
+    response = _ask_daemon({"command": "stats"}, direct)
+    if response is not None:
+        print(response["metrics"], end="")
+        return
+
+    from tickertock.metrics import METRICS_PATH
+
+    try:
+        print(METRICS_PATH.read_text(), end="")
+    except OSError:
+        print("No metrics yet - is tickertock running?")
+        sys.exit(1)
+
+
 @cli.command()
 @click.argument("deckfile", required=False)
+@click.option("--wait-for", type=int, help="Number of decks to wait for, rather than waiting for them to settle")
+@click.option("--timeout", type=float, default=10.0, show_default=True, help="Longest to wait for decks (s)")
+@click.option("--settle", type=float, default=1.0, show_default=True, help="Time with no new decks before carrying on (s)")
+@click.option("--json", "as_json", is_flag=True, help="Print a JSON summary instead of text")
 @click.pass_obj
-def writeout(obj, deckfile):
+def writeout(obj, deckfile, wait_for, timeout, settle, as_json):
+    from tickertock.ui import (
+        TickertockApplication,
+        merge_streamdeck_config,
+        TickertockStreamDeckServer,
+    )
+
     application = TickertockApplication(obj)
     if deckfile:
         shutil.copyfile(deckfile, f'{deckfile}.{datetime.datetime.now().strftime("%s")}.bak')
@@ -58,11 +153,14 @@ def writeout(obj, deckfile):
 
     server = TickertockStreamDeckServer(obj)
     server.start()
-    print("Waiting for decks to attach (3s)")
-    time.sleep(3)
-    print("Found:")
-    for deck in server.decks:
-        print("  ", deck)
+    if not as_json:
+        print("Waiting for decks to attach")
+    decks = server.wait_for_decks(expected=wait_for, settle=settle, timeout=timeout)
+    if not as_json:
+        print("Found:")
+    for deck in decks:
+        if not as_json:
+            print("  ", deck)
         if deck not in streamdeck_input["state"]:
             streamdeck_input["state"][deck] = {}
     streamdeck_input = merge_streamdeck_config(
@@ -73,11 +171,26 @@ def writeout(obj, deckfile):
     )
 
     HOME = os.environ.get("HOME")
-    with open(os.path.join(HOME, ".streamdeck_ui.json"), "w") as f:
+    output = os.path.join(HOME, ".streamdeck_ui.json")
+    with open(output, "w") as f:
         json.dump(streamdeck_input, f)
     logging.info("Streamdeck UI configuration written")
+
+    if as_json:
+        summary = {
+            "output": output,
+            "decks": [
+                dict(serial=deck, **server.get_deck(deck)) for deck in decks
+            ],
+            "complete": wait_for is None or len(decks) >= wait_for,
+        }
+        print(json.dumps(summary))
     server.stop()
 
+    if wait_for is not None and len(decks) < wait_for:
+        logging.error(f"Only found {len(decks)} of {wait_for} decks")
+        sys.exit(1)
+
 
 @cli.command()
 @click.pass_obj
@@ -89,22 +202,36 @@ def version(obj):
 @cli.command()
 @click.pass_obj
 def ui(obj):
+    from tickertock.ui import TickertockApplication
+
     sys.argv = ["streamdeck", "-n"] + sys.argv[3:]
     application = TickertockApplication(obj)
     code = application.run()
     return code
 
 
+@cli.command()
+@click.pass_obj
+def headless(obj):
+    from tickertock.headless import HeadlessApplication
+
+    return HeadlessApplication(obj).run()
+
+
 @cli.command()
 @click.option("--clockify-api-key", required=True)
 @click.option("--clockify-workspace-id", required=True)
 def init(clockify_api_key, clockify_workspace_id):
+    import toml
+    from tickertock.skel import initialize as skel_initialize
+    from tickertock.tickertock import Tickertock
+
     skel_initialize(
         clockify_api_key=clockify_api_key, clockify_workspace_id=clockify_workspace_id
     )
 
     tickertock = Tickertock("clockify")
-    tickertock.initialize()
+    tickertock.initialize(with_images=False)
     projects = tickertock.tocker.get_all_projects()
     projects = [
         p
@@ -0,0 +1,277 @@
+"""
+Shared HTTP session for talking to timetracking APIs.
+
+Keeps one pooled, keep-alive connection around, so a keypress
+costs a single round trip on a warm socket, and makes sure no
+call can hang the Qt event loop indefinitely.
+"""
+
+import re
+import time
+import datetime
+import email.utils
+import random
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from .metrics import METRICS
+
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF = 0.3
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Longest we will hold up the worker to honour a Retry-After -
+# beyond this, the call fails and the caller tries again later
+MAX_RETRY_AFTER = 5
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PATCH", "PUT", "DELETE")
+
+# Object ids in paths, so metrics group by endpoint, not by user
+_ID_PATTERN = re.compile(r"/[0-9a-f]{24}(?=/|$)")
+
+
+def endpoint_label(method, path):
+    return f"{method} {_ID_PATTERN.sub('/:id', path.split('?')[0].rstrip('/'))}"
+
+
+def retry_after(response):
+    """
+    Seconds the server has asked us to wait, from Retry-After
+    (either form) or from X-RateLimit-Remaining/Reset, if it
+    said at all.
+    """
+
+    headers = response.headers
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(value)
+            except (TypeError, ValueError):
+                return None
+            now = datetime.datetime.now(datetime.timezone.utc)
+            return max(0.0, (when - now).total_seconds())
+
+    if headers.get("X-RateLimit-Remaining") == "0":
+        try:
+            reset = float(headers.get("X-RateLimit-Reset"))
+        except (TypeError, ValueError):
+            return None
+        # Some APIs give an epoch time, others a number of seconds
+        return max(0.0, reset - time.time()) if reset > 1e9 else reset
+    return None
+
+
+def never_connected(error):
+    """
+    Whether a request failed before a connection was open - timed
+    out connecting, refused, or the name did not resolve - so the
+    server cannot have seen it.
+    """
+
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError) or not error.args:
+        return False
+    reason = getattr(error.args[0], "reason", error.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+def rejected(error):
+    """
+    Whether the API turned a request down outright (a 4xx other
+    than a rate limit), so sending it again would fail the same way.
+    """
+
+    response = getattr(error, "response", None)
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and response is not None
+        and 400 <= response.status_code < 500
+        and response.status_code not in RETRY_STATUSES + (408,)
+    )
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """
+    Raised without touching the network when the API has
+    failed too often recently to be worth trying again yet.
+    """
+
+    pass
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failures and, once past a threshold, refuses
+    calls until a cool-off has passed. After that, a single trial
+    call is let through - success closes the circuit, failure
+    re-opens it.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            if self.opened_at is None:
+                return False
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                return True
+            if self._trial_at is not None and now - self._trial_at < self.reset_timeout:
+                # Someone else's trial call is still out
+                return True
+            # Half-open: let this call through as the trial
+            self._trial_at = now
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._trial_at = None
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning("API circuit opened after %d failures", self.failures)
+                self.opened_at = time.monotonic()
+
+
+class TockerSession:
+    """
+    Wrapper round a requests.Session with a fixed base URL and
+    headers, timeouts on every call, retries with jittered
+    exponential backoff and a circuit breaker.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        headers=None,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout=DEFAULT_RESET_TIMEOUT,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.throttled_until = 0.0
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _sleep_backoff(self, attempt, wait=None):
+        # Full jitter, so a fleet of decks does not retry in lockstep
+        time.sleep(max(wait or 0, random.uniform(0, self.backoff * (2**attempt))))
+
+    @property
+    def throttled_for(self):
+        """
+        Seconds until the API has said it will take more calls.
+        """
+
+        return max(0.0, self.throttled_until - time.monotonic())
+
+    def _note_rate_limit(self, response):
+        wait = retry_after(response)
+        if wait:
+            self.throttled_until = max(self.throttled_until, time.monotonic() + wait)
+        return wait
+
+    def request(self, method, path, **kwargs):
+        """
+        Make a request, returning the response once it is
+        successful, or raising once retries are exhausted.
+        """
+
+        method = method.upper()
+        if self.breaker.is_open:
+            raise CircuitOpenError(f"API unavailable, not trying {method} {path}")
+
+        kwargs.setdefault("timeout", self.timeout)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        idempotent = method in IDEMPOTENT_METHODS
+        endpoint = endpoint_label(method, path)
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.exceptions.RequestException as e:
+                # Only retry what might have been processed if harmless -
+                # anything that never reached the server is always safe
+                error, retryable = e, idempotent or never_connected(e)
+                status = type(e).__name__
+            else:
+                error, status = None, response.status_code
+            METRICS.observe(
+                "tickertock_api_request_seconds",
+                time.perf_counter() - start,
+                endpoint=endpoint,
+                status=status,
+            )
+
+            wait = None
+            if error is None:
+                wait = self._note_rate_limit(response)
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    response.raise_for_status()
+                    return response
+                error = requests.exceptions.HTTPError(
+                    f"{response.status_code} for {method} {path}", response=response
+                )
+                retryable = idempotent or response.status_code == 429
+                if wait and wait > MAX_RETRY_AFTER:
+                    retryable = False
+
+            if attempt >= self.retries or not retryable:
+                self.breaker.record_failure()
+                raise error
+
+            self._sleep_backoff(attempt, wait)
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.request("PATCH", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
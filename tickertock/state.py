@@ -0,0 +1,63 @@
+import time
+import datetime
+from collections import namedtuple
+
+
+class TrackerSnapshot(
+    namedtuple(
+        "TrackerSnapshot",
+        ["project", "project_id", "entry_id", "started", "anchor"],
+        defaults=(None,),
+    )
+):
+    """
+    Immutable view of the tracker at one moment, so every deck and
+    the tray can read the same state without asking the tocker again.
+
+    `started` is a naive UTC datetime, `project` is None when
+    nothing is being tracked. `anchor` is the monotonic clock
+    reading matching `started`, so elapsed time keeps ticking
+    steadily between syncs, whatever the wall clock does.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def anchored(cls, project, project_id, entry_id, started):
+        anchor = None
+        if started:
+            since = datetime.datetime.utcnow() - started
+            anchor = time.monotonic() - since.total_seconds()
+        return cls(project, project_id, entry_id, started, anchor)
+
+    def elapsed(self, now=None):
+        if not self.started:
+            return None
+        if now is None:
+            if self.anchor is not None:
+                return datetime.timedelta(seconds=time.monotonic() - self.anchor)
+            now = datetime.datetime.utcnow()
+        return now - self.started
+
+    def until_next_minute(self):
+        """
+        Seconds until the clockface for this snapshot next changes.
+        """
+
+        elapsed = self.elapsed()
+        if elapsed is None:
+            return None
+        return 60 - elapsed.total_seconds() % 60
+
+    @property
+    def clock_key(self):
+        """
+        Hours and minutes shown on the clockface - snapshots with
+        the same key render to the same image.
+        """
+
+        elapsed = self.elapsed()
+        if elapsed is None:
+            return None
+        secs = elapsed.total_seconds()
+        return int(secs // 3600), int(secs // 60 % 60)
@@ -1,10 +1,29 @@
 import toml
+import time
 import logging
+import datetime
+import threading
+from functools import partial
+from collections import OrderedDict
 from . import clockify
-from .config import CONFIG_DIR, STREAMDECK_IMAGE_DIR
-from .utils import draw_colour
+from .session import rejected
+from .config import CACHE_DIR, CONFIG_DIR, DATA_DIR, STREAMDECK_IMAGE_DIR
+from .journal import ToggleJournal
+from .timesheet import Timesheet, PERIODS, period_start
+from .metrics import METRICS
 
 TOCKERS = {"clockify": clockify.ClockifyTocker}
+JOURNAL_PATH = DATA_DIR / "journal.sqlite"
+JOURNAL_BATCH_SIZE = 20
+# Toggles closer together than this are merged into the last one
+COALESCE_WINDOW_MS = 750
+TIMESHEET_PATH = DATA_DIR / "timesheet.sqlite"
+# Refetch the whole period this often, to catch edits made elsewhere
+TIMESHEET_RECONCILE_INTERVAL = 3600
+TIMESHEET_KEEP_DAYS = 8
+# Colour tiles kept drawn - the rest are redrawn (or read from the
+# tile cache directory) when their page is next shown
+TILE_CACHE_SIZE = 256
 
 class UninitializedError(Exception):
     pass
@@ -18,20 +37,108 @@ class Tickertock:
 
     def __init__(self, tocker_type):
         self._projects = None
+        self._journal = None
+        self._timesheet = None
+        self._last_started = None
+        self._rejected = []
+        self._rejected_lock = threading.Lock()
+        self._tiles = OrderedDict()
+        self._tiles_lock = threading.Lock()
+        self.tocker_type = tocker_type
         self.load_config()
         self.tocker = TOCKERS[tocker_type].from_config(self.config[tocker_type])
 
-    def initialize(self):
-        self.load_images()
-        self.tocker.initialize()
+    def initialize(self, with_images=True, refresh=False):
+        """
+        Get ready to run. Quick commands can skip drawing images.
+        The tocker's project list comes from its cache, unless
+        there is none yet or `refresh` is set.
+        """
+
+        if with_images:
+            self.load_images()
+        self.tocker.initialize(
+            CACHE_DIR / f"{self.tocker_type}-projects.json", refresh=refresh
+        )
+        if self.totals_period:
+            self.tocker.timesheet = self.timesheet
+
+    def load_images(self, codes=None):
+        """
+        Find asset PNGs for the projects that have them. Colour
+        tiles for the rest are only drawn when a page showing them
+        is built - see project_images.
+        """
 
-    def load_images(self):
         for code, project in self.projects.items():
+            if codes is not None and code not in codes:
+                continue
             image_path = STREAMDECK_IMAGE_DIR / f"{code.lower()}.png"
             if image_path.exists():
                 project["image"] = str(image_path)
-            elif "colour" in project:
-                project["image"] = draw_colour(code, project["colour"])
+        self.forget_images(codes)
+
+    def forget_images(self, codes=None):
+        with self._tiles_lock:
+            if codes is None:
+                self._tiles.clear()
+            for code in codes or ():
+                self._tiles.pop(code, None)
+
+    def missing_images(self, codes):
+        """
+        Those of these projects whose tile would have to be drawn.
+        """
+
+        with self._tiles_lock:
+            return [
+                code
+                for code in codes
+                if code in self.projects
+                and "image" not in self.projects[code]
+                and "colour" in self.projects[code]
+                and code not in self._tiles
+            ]
+
+    def project_images(self, codes):
+        """
+        Images for these projects, by code: an asset PNG's path or a
+        colour tile, drawing any tiles not already drawn together.
+        Safe from any thread.
+        """
+
+        images = {}
+        with self._tiles_lock:
+            for code in codes:
+                project = self.projects.get(code, {})
+                if "image" in project:
+                    images[code] = project["image"]
+                elif code in self._tiles:
+                    self._tiles.move_to_end(code)
+                    images[code] = self._tiles[code]
+
+        missing = {
+            code: self.projects[code]["colour"] for code in self.missing_images(codes)
+        }
+        METRICS.inc("tickertock_tile_cache_total", len(images), result="hit")
+        if not missing:
+            return images
+
+        # Only pull in cairo when we actually need to draw
+        from .utils import draw_colours
+
+        METRICS.inc("tickertock_tile_cache_total", len(missing), result="miss")
+        drawn = draw_colours(missing, cache_dir=CACHE_DIR / "tiles")
+        with self._tiles_lock:
+            for code, image in drawn.items():
+                self._tiles[code] = image
+            while len(self._tiles) > TILE_CACHE_SIZE:
+                self._tiles.popitem(last=False)
+        images.update(drawn)
+        return images
+
+    def project_image(self, code):
+        return self.project_images((code,)).get(code)
 
     @property
     def projects(self):
@@ -39,27 +146,271 @@ class Tickertock:
             self.load_projects()
         return self._projects
 
-    def toggle(self, project):
+    @property
+    def coalesce_window(self):
+        return self.config.get("coalesceWindow", COALESCE_WINDOW_MS) / 1000
+
+    @property
+    def totals_period(self):
+        period = self.config.get("showTotals", "today")
+        return period if period in PERIODS else None
+
+    @property
+    def timesheet(self):
+        if self._timesheet is None:
+            self._timesheet = Timesheet(TIMESHEET_PATH)
+        return self._timesheet
+
+    def refresh_timesheet(self):
+        """
+        Fetch entries only when the timesheet has reason to think it
+        is missing some: entries that were running but are no longer
+        and whose end we never saw, or an hourly (or new day's)
+        reconcile. Returns the number fetched, or None if there was
+        no need.
+        """
+
+        start = period_start(self.totals_period)
+        timesheet = self.timesheet
+        reconciled = float(timesheet.get_meta("reconciledAt", 0))
+        if (
+            timesheet.get_meta("period") != start.isoformat()
+            or time.time() - reconciled > TIMESHEET_RECONCILE_INTERVAL
+        ):
+            since = start
+        else:
+            dangling = [
+                started
+                for entry_id, started in timesheet.open_entries()
+                if entry_id != self.tocker.active_entry
+            ]
+            if not dangling:
+                return None
+            since = min(dangling)
+
+        fetched = self.tocker.refresh_timesheet(since)
+        if since == start:
+            timesheet.set_meta("period", start.isoformat())
+            timesheet.set_meta("reconciledAt", time.time())
+            timesheet.prune(start - datetime.timedelta(days=TIMESHEET_KEEP_DAYS))
+        return fetched
+
+    def project_totals(self, snapshot=None):
+        """
+        Seconds tracked on each project (by code) this period, from
+        the timesheet plus the running entry in `snapshot`.
+        """
+
+        start = period_start(self.totals_period)
+        by_id = self.timesheet.totals(start)
+        running = 0
+        if snapshot and snapshot.started:
+            since_start = (datetime.datetime.utcnow() - start).total_seconds()
+            running = min(snapshot.elapsed().total_seconds(), since_start)
+
+        totals = {}
+        for code, project in self.projects.items():
+            if project["name"] not in self.tocker.projects:
+                continue
+            pid = self.tocker.projects.id_for(project["name"])
+            totals[code] = by_id.get(pid, 0)
+            if snapshot and snapshot.project_id == pid:
+                totals[code] += running
+        return totals
+
+    @property
+    def journal(self):
+        if self._journal is None:
+            self._journal = ToggleJournal(JOURNAL_PATH)
+        return self._journal
+
+    def record_toggle(self, project, when=None, refresh=False):
+        """
+        Write a toggle to the journal, before anything is sent to
+        the tocker. Returns None if the project is unknown, here or
+        to the tocker - which is only asked again with `refresh`.
+        """
+
         if project in self.projects:
-            pid = self.tocker.get_project_id(self.projects[project]["name"])
-            try:
-                result = self.tocker.start_time_entry("(to fill in)", pid)
-            except Exception as e:
-                print(e)
-                logging.error("could not toggl")
-                success = False
-            else:
-                logging.info(f"Toggled {project}")
-                success = project
+            name = self.projects[project]["name"]
+            pid = self.tocker.get_project_id(name, refresh=refresh)
+            if pid is None:
+                logging.error(f"Project {name} is not in {self.tocker_type}")
+                return None
         elif project == "None":
-            current_timer = self.tocker.stop_time_entry()
-            logging.info("Toggl off")
-            success = True
+            pid = None
         else:
             logging.error("Unknown project")
-            success = False
+            return None
+        return self.journal.append(project, pid, when)
+
+    def knows_project(self, project):
+        """
+        Whether the tocker has a project we have in projects.toml.
+        """
+
+        return project in self.projects and self.projects[project]["name"] in self.tocker.projects
+
+    def flush(self, batch_size=JOURNAL_BATCH_SIZE, window=0):
+        """
+        Replay pending journal events to the tocker, oldest first,
+        stopping at the first failure so order is kept. Events the
+        tocker rejects outright are marked failed and skipped (see
+        take_rejected). Returns the number of events still pending.
 
-        return success
+        With a coalescing `window` (seconds), only the last of a
+        burst of toggles is sent, and the newest is held back until
+        it is old enough that no further press can supersede it.
+        """
+
+        window = datetime.timedelta(seconds=window)
+        now = datetime.datetime.utcnow()
+        replayed = False
+        while True:
+            # One extra, to see whether the last of the batch is superseded
+            events = self.journal.pending(batch_size + 1)
+            if not events:
+                if replayed:
+                    self.journal.prune()
+                return 0
+            replayed = True
+            batch = events[:batch_size]
+            for event, later in zip(batch, events[1:] + [None]):
+                if later is None and now - event.at < window:
+                    return 1
+
+                if later is not None and not event.attempts and later.at - event.at < window:
+                    # Never sent, and already superseded
+                    self.journal.mark_sent(event)
+                    METRICS.inc("tickertock_toggles_coalesced_total")
+                    continue
+
+                if event.attempts and self.tocker.is_applied(event.project_id, event.at):
+                    # An earlier attempt landed, but we never heard back
+                    self.journal.mark_sent(event)
+                    continue
+
+                self.journal.mark_attempt(event)
+                try:
+                    self._send(event, window)
+                except Exception as e:
+                    if not rejected(e):
+                        raise
+                    self._reject(event, e)
+
+    def _send(self, event, window):
+        discarded = self._discard_superseded(event, window)
+        if event.project_id is None:
+            if not discarded:
+                self.tocker.stop_time_entry(event.at, current=partial(self._is_latest, event))
+            self.journal.mark_sent(event)
+            logging.info("Toggl off", extra=self._sent_fields(event))
+        else:
+            sent_at = datetime.datetime.utcnow()
+            entry = self.tocker.start_time_entry(
+                "(to fill in)",
+                event.project_id,
+                event.at,
+                current=partial(self._is_latest, event),
+            )
+            self.journal.mark_sent(event, entry.get("id"))
+            self._last_started = (entry.get("id"), sent_at, datetime.datetime.utcnow())
+            logging.info(f"Toggled {event.project}", extra=self._sent_fields(event))
+
+    def _reject(self, event, error):
+        """
+        Give up on an event the tocker will never take (an archived
+        project, say), rather than hold every later toggle up.
+        """
+
+        self.journal.mark_failed(event)
+        METRICS.inc("tickertock_toggles_rejected_total")
+        logging.warning(f"Toggle to {event.project} rejected: {error}")
+        with self.tocker.state_lock:
+            if self._is_latest(event):
+                # Shown locally, but never happened - let the next
+                # sync say what is really running
+                self.tocker.restore_state((None, None, None))
+        with self._rejected_lock:
+            self._rejected.append(event)
+
+    def take_rejected(self):
+        """
+        Events rejected since this was last called, to tell the user.
+        """
+
+        with self._rejected_lock:
+            events, self._rejected = self._rejected, []
+        return events
+
+    def _is_latest(self, event):
+        # Called with the tocker's state lock held, which apply_toggle
+        # also holds while journalling, so no toggle can slip between
+        return self.journal.latest_id() == event.id
+
+    @staticmethod
+    def _sent_fields(event):
+        # For the log: how long after the press it reached Clockify
+        lag = datetime.datetime.utcnow() - event.at
+        return {
+            "command": "toggle",
+            "project": event.project,
+            "latency_ms": round(lag.total_seconds() * 1000, 1),
+            "attempts": event.attempts + 1,
+        }
+
+    def _discard_superseded(self, event, window):
+        """
+        If this event was pressed while the entry we last started was
+        on its way to the tocker, or within `window` of it landing -
+        too late to coalesce them - delete that entry, rather than
+        leave a near-empty one behind.
+        """
+
+        last, self._last_started = self._last_started, None
+        if last is None or not last[0]:
+            return False
+        entry_id, sent_at, finished_at = last
+        # Anything pressed before it was sent was already weighed up
+        # by the coalescing in flush
+        if event.at < sent_at or event.at - finished_at >= window:
+            return False
+        self.tocker.discard_time_entry(entry_id)
+        METRICS.inc("tickertock_entries_discarded_total")
+        logging.info(f"Discarded superseded entry {entry_id}")
+        return True
+
+    def toggle(self, project, when=None):
+        event = self.record_toggle(project, when, refresh=True)
+        if event is None:
+            return False
+
+        try:
+            self.flush()
+        except Exception as e:
+            print(e)
+            logging.error("could not toggl, journalled for replay")
+
+        if any(rejected.id == event.id for rejected in self.take_rejected()):
+            print(f"Toggle to {project} was rejected")
+            return False
+        return project if event.project_id else True
+
+    def optimistic_toggle(self, project):
+        """
+        Update the local tracking state straight away, ahead of a
+        toggle reaching the tocker. Returns the previous state, so
+        it can be restored if the toggle fails.
+        """
+
+        previous = self.tocker.save_state()
+        if project in self.projects:
+            pid = self.tocker.get_project_id(self.projects[project]["name"])
+            if pid is not None:
+                self.tocker.set_local_state(pid)
+        else:
+            self.tocker.set_local_state(None)
+        return previous
 
     def load_config(self):
         if not CONFIG_DIR.exists():
@@ -70,6 +421,9 @@ class Tickertock:
 
         self.config = config
 
+        self.load_projects()
+
+    def load_projects(self):
         with open(CONFIG_DIR / "projects.toml", "r") as f:
             project_config = toml.load(f)
         self._projects = {
@@ -77,3 +431,44 @@ class Tickertock:
             for key, project in project_config["projects"].items()
         }
         self.entries = project_config["page"]["entries"]
+
+    def reload_config(self):
+        """
+        Re-read config.toml, returning the top-level keys
+        (or sections) that changed.
+        """
+
+        old = self.config
+        with open(CONFIG_DIR / "config.toml", "r") as f:
+            self.config = toml.load(f)
+        return {
+            key
+            for key in set(old) | set(self.config)
+            if old.get(key) != self.config.get(key)
+        }
+
+    def reload_projects(self, with_images=True):
+        """
+        Re-read projects.toml, redrawing images only for projects
+        that changed. Returns the codes of projects that were added,
+        removed or changed, and whether the entries list changed.
+        """
+
+        def settings(project):
+            return {k: v for k, v in project.items() if k != "image"}
+
+        old_projects, old_entries = self._projects or {}, self.entries
+        self.load_projects()
+
+        changed = set(old_projects) ^ set(self._projects)
+        for code, project in self._projects.items():
+            if code in old_projects:
+                if settings(project) == settings(old_projects[code]):
+                    if "image" in old_projects[code]:
+                        project["image"] = old_projects[code]["image"]
+                else:
+                    changed.add(code)
+
+        if with_images and changed:
+            self.load_images(changed & set(self._projects))
+        return changed, self.entries != old_entries
@@ -0,0 +1,164 @@
+"""
+Local store of time entries, kept up to date from what the tocker
+tells us anyway - toggles, polls and webhooks - and only fetched
+incrementally when something is missing, so per-project totals can
+be shown on every tick without asking the timetracker for reports.
+"""
+
+import sqlite3
+import datetime
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    id TEXT PRIMARY KEY,
+    project_id TEXT,
+    start TEXT NOT NULL,
+    end TEXT
+);
+CREATE INDEX IF NOT EXISTS entries_start ON entries (start);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+PERIODS = ("today", "week")
+
+
+def period_start(period, now=None):
+    """
+    Start of the local day (or week) as a naive UTC datetime, the
+    same as entries are stored in.
+    """
+
+    if now is None:
+        now = datetime.datetime.now().astimezone()
+    start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    if period == "week":
+        start -= datetime.timedelta(days=start.weekday())
+    return start.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def format_total(seconds):
+    """
+    Short enough for the bottom of a button: 25m, 1h05.
+    """
+
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h{minutes % 60:02d}"
+
+
+class Timesheet:
+    """
+    SQLite table of time entries, with times as naive UTC ISO
+    strings. Totals of finished entries are cached, so reading
+    them every tick costs nothing until an entry changes.
+    """
+
+    def __init__(self, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._totals = None
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+
+    def record(self, entry_id, project_id, start, end=None):
+        row = (project_id, start.isoformat(), end.isoformat() if end else None)
+        with self._lock, self._db:
+            current = self._db.execute(
+                "SELECT project_id, start, end FROM entries WHERE id = ?", (entry_id,)
+            ).fetchone()
+            if current == row:
+                return False
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (id, project_id, start, end) VALUES (?, ?, ?, ?)",
+                (entry_id,) + row,
+            )
+            self._totals = None
+        return True
+
+    def remove(self, entry_id):
+        with self._lock, self._db:
+            if self._db.execute("DELETE FROM entries WHERE id = ?", (entry_id,)).rowcount:
+                self._totals = None
+
+    def close_open(self, at, keep=None):
+        """
+        End every running entry but `keep` at `at` - starting a timer
+        stops whatever was running before.
+        """
+
+        with self._lock, self._db:
+            if self._db.execute(
+                "UPDATE entries SET end = ? WHERE end IS NULL AND id IS NOT ?",
+                (at.isoformat(), keep),
+            ).rowcount:
+                self._totals = None
+
+    def open_entries(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, start FROM entries WHERE end IS NULL"
+            ).fetchall()
+        return [(row[0], datetime.datetime.fromisoformat(row[1])) for row in rows]
+
+    def forget_missing(self, since, ids):
+        """
+        Drop entries from `since` on that the tocker no longer has.
+        """
+
+        with self._lock, self._db:
+            stored = self._db.execute(
+                "SELECT id FROM entries WHERE start >= ?", (since.isoformat(),)
+            ).fetchall()
+            gone = [(row[0],) for row in stored if row[0] not in ids]
+            if gone:
+                self._db.executemany("DELETE FROM entries WHERE id = ?", gone)
+                self._totals = None
+
+    def totals(self, since):
+        """
+        Seconds of finished entries since `since`, by project id.
+        """
+
+        with self._lock:
+            if self._totals is not None and self._totals[0] == since:
+                return self._totals[1]
+            rows = self._db.execute(
+                """
+                SELECT project_id,
+                       SUM(julianday(end) - julianday(MAX(start, ?))) * 86400
+                FROM entries
+                WHERE end IS NOT NULL AND end > ?
+                GROUP BY project_id
+                """,
+                (since.isoformat(), since.isoformat()),
+            ).fetchall()
+            self._totals = (since, {row[0]: row[1] for row in rows})
+            return self._totals[1]
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value))
+            )
+
+    def prune(self, before):
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM entries WHERE end IS NOT NULL AND end < ?", (before.isoformat(),)
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
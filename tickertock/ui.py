@@ -7,35 +7,69 @@ you have (e.g. handle_keypress) and sorry for inserting them
 where we shouldn't (e.g. create_tray).
 """
 
-import filetype
-import json
-import datetime
+import time
+import queue
+import logging
+import threading
 from functools import partial
-from streamdeck_ui import gui, api, display
-from pynput.keyboard import Controller
+from streamdeck_ui import gui, api
 from PySide6.QtWidgets import QApplication
-from streamdeck_ui.config import LOGO
+from streamdeck_ui.config import LOGO, DEFAULT_FONT
+from streamdeck_ui.display.filter import Filter
+from streamdeck_ui.display.image_filter import ImageFilter
+from streamdeck_ui.display.pulse_filter import PulseFilter
+from streamdeck_ui.display.text_filter import TextFilter
 from PySide6.QtGui import QIcon, QPixmap, QImage, QDesktopServices, QAction
-from PySide6.QtCore import QTimer, QUrl
+from PySide6.QtCore import Qt, QObject, QTimer, QUrl, Signal, Slot, SLOT
 from PySide6.QtWidgets import QSystemTrayIcon, QMainWindow, QMenu
-from StreamDeck.Devices import StreamDeck
-from jinja2 import Environment, select_autoescape, FileSystemLoader
 
-from .utils import draw_time
-from .config import CONFIG_DIR, STREAMDECK_IMAGE_DIR
+try:
+    from PySide6.QtDBus import QDBusConnection
+except ImportError:
+    QDBusConnection = None
 
-# Ew.
-filetype_guess = filetype.guess
+from .application import DeckApplication
+from .deckconfig import merge_streamdeck_config
+from .control import CLIENT_TIMEOUT
+from .config import CONFIG_DIR
+from .frames import KeyFrame
 
+# Seconds without a new deck before we assume they have all attached
+DISCOVERY_SETTLE = 1.0
+DISCOVERY_TIMEOUT = 10.0
 
-def _filetype_guess(*args, **kwargs):
-    try:
-        return filetype_guess(*args, **kwargs)
-    except TypeError:
-        return True
 
+class FrameFilter(Filter):
+    """
+    ImageFilter for frames we drew ourselves: the pixels go in as
+    they are, with no PNG to sniff and decode, and the frame's key
+    is the hashcode, so streamdeck_ui's cache of encoded frames
+    tells clockfaces apart without any help.
+    """
+
+    def __init__(self, frame):
+        super().__init__()
+        self.frame = frame
+        self.hashcode = hash((self.__class__, frame.key))
+        self.image = None
 
-display.image_filter.filetype.guess = _filetype_guess
+    def initialize(self, size):
+        image = self.frame.image()
+        if image.size != tuple(size):
+            image = image.resize(size)
+        self.image = image
+
+    def transform(self, get_input, get_output, input_changed, time):
+        if not input_changed:
+            return (None, self.hashcode)
+
+        image = get_output(self.hashcode)
+        if image:
+            return (image, self.hashcode)
+
+        image = get_input()
+        image.paste(self.image, self.image)
+        return (image, self.hashcode)
 
 
 class TickertockStreamDeckServer(api.StreamDeckServer):
@@ -47,6 +81,77 @@ class TickertockStreamDeckServer(api.StreamDeckServer):
     def __init__(self, tickertock) -> None:
         super().__init__()
         self.tickertock = tickertock
+        self._decks_changed = threading.Condition()
+
+    def attached(self, streamdeck_id, streamdeck):
+        super().attached(streamdeck_id, streamdeck)
+        with self._decks_changed:
+            self._decks_changed.notify_all()
+
+    def wait_for_decks(self, expected=None, settle=DISCOVERY_SETTLE, timeout=DISCOVERY_TIMEOUT):
+        """
+        Block until `expected` decks have attached or, if no count is
+        given, until no new deck has attached for `settle` seconds.
+        Gives up after `timeout` either way. Returns the serials.
+        """
+
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._decks_changed:
+            count, last_change = len(self.decks), start
+            while True:
+                now = time.monotonic()
+                if expected is not None and len(self.decks) >= expected:
+                    break
+                if now >= deadline:
+                    break
+                if expected is None and now - last_change >= settle:
+                    break
+
+                until = deadline if expected is not None else min(deadline, last_change + settle)
+                self._decks_changed.wait(until - now)
+                if len(self.decks) != count:
+                    count, last_change = len(self.decks), time.monotonic()
+        return list(self.decks)
+
+    def update_button_filters(self, serial_number, page, button):
+        # As streamdeck_ui's, but with our frames skipping ImageFilter
+        display_handler = self.display_handlers[serial_number]
+        button_settings = self._button_state(serial_number, page, button)
+        filters = []
+
+        icon = button_settings.get("icon")
+        if isinstance(icon, KeyFrame):
+            filters.append(FrameFilter(icon))
+        elif icon:
+            filters.append(ImageFilter(icon))
+
+        if button_settings.get("pulse"):
+            filters.append(PulseFilter())
+
+        text = button_settings.get("text")
+        font = button_settings.get("font", DEFAULT_FONT)
+        vertical_align = button_settings.get("text_vertical_align", "")
+        if text:
+            filters.append(TextFilter(text, font, vertical_align))
+
+        display_handler.replace(page, button, filters)
+
+    def apply_updates(self, deck_id, page, buttons):
+        """
+        Make a batch of button changes, {(page, button): settings},
+        and switch page, if given, saving once and without waiting
+        for the display thread to catch up after each one.
+        """
+
+        display_handler = self.display_handlers[deck_id]
+        for (button_page, button), settings in buttons.items():
+            self._button_state(deck_id, button_page, button).update(settings)
+            self.update_button_filters(deck_id, button_page, button)
+        if page is not None:
+            self.state.setdefault(deck_id, {})["page"] = page
+            display_handler.set_page(page)
+        self._save_state()
 
     def export_config(self, output_file: str) -> None:
         pass  # we don't actually want to export this config
@@ -68,98 +173,167 @@ class TickertockStreamDeckServer(api.StreamDeckServer):
             self.get_deck,
             with_images=True,
         )
-        self.state = {}
-        for deck_id, deck in config["state"].items():
-            deck["buttons"] = {
-                int(page_id): {
-                    int(button_id): button for button_id, button in buttons.items()
-                }
-                for page_id, buttons in deck.get("buttons", {}).items()
-            }
-            self.state[deck_id] = deck
+        # Button keys are already ints, as streamdeck_ui expects
+        self.state = dict(config["state"])
 
 
-class TickertockApplication:
+class QtThreadBridge(QObject):
     """
-    Singleton to look after the Qt application and all who
-    sail in her.
+    Carries calls from other threads (the worker, the control
+    socket) onto the Qt thread. As the slot belongs to an object
+    living on the Qt thread, emitting from elsewhere gets queued
+    rather than called directly.
     """
 
-    def handle_update_time(self):
+    called = Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.called.connect(self._deliver)
+
+    def invoke(self, function, *args):
+        self.called.emit(function, args)
+
+    def call(self, function, *args, timeout=CLIENT_TIMEOUT):
         """
-        Periodically make sure everything is synced, including
-        clock on the bottom-right button.
+        Run function on the Qt thread and wait for its result.
         """
 
-        entry = self.tickertock.tocker.get_active_time_entry()
-        for deck_id, _ in self.api.state.items():
-            deck = self.api.decks.get(deck_id, None)
-            if deck:
-                page = self.api.get_page(deck_id)
-                layout = self.api.get_deck(deck_id)["layout"]
-                key_count = layout[0] * layout[1]
-                text = self.api.get_button_text(
-                    deck_id, page if page != 1 else 0, key_count - 1
+        reply = queue.Queue(maxsize=1)
+
+        def run(*args):
+            try:
+                reply.put((function(*args), None))
+            except Exception as e:
+                reply.put((None, e))
+
+        self.invoke(run, *args)
+        result, error = reply.get(timeout=timeout)
+        if error:
+            raise error
+        return result
+
+    @Slot(object, object)
+    def _deliver(self, function, args):
+        function(*args)
+
+
+class SessionMonitor(QObject):
+    """
+    Listens on D-Bus for the screen locking and the machine going
+    to sleep, calling `on_away()` when either starts and `on_back()`
+    once both are over.
+    """
+
+    # Signals to listen for: bus, service, path, interface, name, slot
+    SIGNALS = (
+        (
+            "systemBus",
+            "org.freedesktop.login1",
+            "/org/freedesktop/login1",
+            "org.freedesktop.login1.Manager",
+            "PrepareForSleep",
+            "prepare_for_sleep(bool)",
+        ),
+        (
+            "sessionBus",
+            "org.freedesktop.ScreenSaver",
+            "/org/freedesktop/ScreenSaver",
+            "org.freedesktop.ScreenSaver",
+            "ActiveChanged",
+            "screensaver_active(bool)",
+        ),
+        (
+            "sessionBus",
+            "org.gnome.ScreenSaver",
+            "/org/gnome/ScreenSaver",
+            "org.gnome.ScreenSaver",
+            "ActiveChanged",
+            "screensaver_active(bool)",
+        ),
+    )
+
+    def __init__(self, on_away, on_back):
+        super().__init__()
+        self.on_away = on_away
+        self.on_back = on_back
+        self._asleep = False
+        self._locked = False
+
+    def start(self):
+        if QDBusConnection is None:
+            logging.info("No QtDBus, so syncing carries on while locked or asleep")
+            return False
+
+        connected = False
+        for bus, service, path, interface, name, slot in self.SIGNALS:
+            connection = getattr(QDBusConnection, bus)()
+            if connection.isConnected():
+                connected |= connection.connect(
+                    service, path, interface, name, self, SLOT(slot)
                 )
+        return connected
+
+    def _update(self, asleep=None, locked=None):
+        was_away = self._asleep or self._locked
+        if asleep is not None:
+            self._asleep = asleep
+        if locked is not None:
+            self._locked = locked
+
+        away = self._asleep or self._locked
+        if away and not was_away:
+            self.on_away()
+        elif was_away and not away:
+            self.on_back()
+
+    @Slot(bool)
+    def prepare_for_sleep(self, sleeping):
+        self._update(asleep=sleeping)
+
+    @Slot(bool)
+    def screensaver_active(self, active):
+        self._update(locked=active)
 
-                project, elapsed = self.tickertock.tocker.elapsed()
-                if project:
-                    if text != f"@{project}":
-                        self.api.set_page(deck_id, 0)
-                        self.api.set_button_text(
-                            deck_id, 0, key_count - 1, f"@{project}"
-                        )
-                    image = draw_time(elapsed.total_seconds())
-                    self.api.set_button_icon(deck_id, 0, key_count - 1, image)
-
-    def handle_keypress_additional(self, deck_id: str, key: int, state: bool) -> None:
-        """
-        Confuse anyone who is looking at handle_keypress in streamdeck_ui in the naive
-        hope that that's where the logic is.
-        """
 
-        if not state:
-            return
-
-        keyboard = Controller()
-        page = self.api.get_page(deck_id)
-        layout = self.api.get_deck(deck_id)["layout"]
-        key_count = layout[0] * layout[1]
-        text = self.api.get_button_text(deck_id, page if page != 1 else 0, key)
-        if text and key != key_count - 1:
-            self.tickertock.toggle(text)
-            project = self.tickertock.projects[text]
-            self.api.set_button_text(deck_id, 0, key_count - 1, f"@{text}")
-            image = project.get("image", LOGO)
-            if isinstance(image, str):
-                logo = QIcon(image)
-            else:
-                qimage = QImage()
-                qimage.loadFromData(image.getvalue(), "PNG")
-                qpixmap = QPixmap.fromImage(qimage)
-                logo = QIcon(qpixmap)
-        else:
-            self.tickertock.toggle("None")
-            self.api.set_button_text(deck_id, 0, key_count - 1, "NOT RUN")
-            logo = QIcon(LOGO)
-        self.tray.setIcon(logo)
-
-        page_count = round(len(self.tickertock.entries) / (key_count - 1) + 0.4999) + 1
-        # We do not know the original page
-        # switch_page = api.get_button_switch_page(deck_id, page, key)
-        if key != key_count - 1:
-            self.api.set_page(deck_id, 0)
-            self.tickertock.tocker.when = datetime.datetime.utcnow()
-            self.handle_update_time()
-        elif text.startswith("@"):
-            self.api.set_page(deck_id, 1)
-        elif page > 0:
-            self.api.set_page(deck_id, page % (page_count - 1) + 1)
-        else:
-            self.api.set_page(deck_id, min(page_count - 1, 2))
+class TickertockApplication(DeckApplication):
+    """
+    Singleton to look after the Qt application and all who
+    sail in her.
+    """
+
+    def make_timer(self, callback, single_shot=True, precise=False):
+        timer = QTimer()
+        timer.setSingleShot(single_shot)
+        if precise:
+            timer.setTimerType(Qt.TimerType.PreciseTimer)
+        timer.timeout.connect(callback)
+        return timer
+
+    def show_tray_project(self, code):
+        self.tray.setIcon(self.assets.icon(code))
+
+    def warn(self, message):
+        self.tray.showMessage("Tickertock", message, QSystemTrayIcon.MessageIcon.Warning)
+
+    def page_capacity(self, deck_id):
+        # streamdeck_ui only sets up display pipelines at start
+        return len(self.api.display_handlers[deck_id].pages)
+
+    def make_icon(self, image):
+        if image is None:
+            return QIcon(LOGO)
+        if isinstance(image, str):
+            return QIcon(image)
+        # Straight from the pixels, rather than via a PNG
+        pixels = image.image()
+        qimage = QImage(
+            pixels.tobytes("raw", "RGBA"), *pixels.size, QImage.Format.Format_RGBA8888
+        )
+        return QIcon(QPixmap.fromImage(qimage))
 
     def __init__(self, tickertock):
-        self.tickertock = tickertock
+        super().__init__(tickertock)
         # Ew. We want the tray, so we take the tray.
         # Carpe trayem.
         self._sd_create_tray = gui.create_tray
@@ -202,68 +376,24 @@ class TickertockApplication:
     def run(self):
         gui.StreamDeckServer = partial(TickertockStreamDeckServer, self.tickertock)
 
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.handle_update_time)
+        self.bridge = QtThreadBridge()
+        self.start_worker(self.bridge.invoke)
 
         # from gui.py
         # Credit to streamdeck_ui folks for this snippet.
         code = gui.start(_exit=True)
         self.api = gui.api
-        self.handle_update_time()
 
         app = QApplication.instance()
 
         self.api.streamdeck_keys.key_pressed.connect(self.handle_keypress_additional)
-        self.timer.start(self.tickertock.config["syncRate"])
+
+        self.start_services(self.bridge.invoke, self.bridge.call)
+
+        self.session_monitor = SessionMonitor(self.handle_away, self.handle_back)
+        self.session_monitor.start()
         app.exec_()
 
+        self.stop_services()
         self.api.stop()
         return code
-
-
-def merge_streamdeck_config(tickertock, streamdeck_input, get_deck, with_images=False):
-    env = Environment(
-        loader=FileSystemLoader(CONFIG_DIR), autoescape=select_autoescape()
-    )
-    template = env.get_template("streamdeck_ui.json.j2")
-    for device, deck in streamdeck_input["state"].items():
-        try:
-            deck = get_deck(device)
-            layout = deck["layout"]
-            buttons = layout[0] * layout[1]
-        except Exception as e:
-            print(e)
-            buttons = len(list(deck["buttons"].values())[0])
-
-        items = tickertock.entries
-        pages = [
-            {
-                "entries": {
-                    code: tickertock.projects[code] for code in items[i : i + buttons]
-                }
-            }
-            for i in range(0, len(items), buttons)
-        ]
-        inset_json = template.render(
-            len=len,
-            enumerate=enumerate,
-            isinstance=isinstance,
-            streamdeck_image_dir=STREAMDECK_IMAGE_DIR,
-            str=str,
-            list=list,
-            pages=pages,
-            buttons=buttons,
-        )
-        inset = json.loads(inset_json)
-
-        if with_images:
-            for page in inset["buttons"].values():
-                for entry in page.values():
-                    if "text" in entry:
-                        project = tickertock.projects.get(entry["text"], {})
-                        if "image" in project:
-                            entry["icon"] = project["image"]
-        streamdeck_input["state"][device] = inset
-
-    streamdeck_input["streamdeck_ui_version"] = 1
-    return streamdeck_input
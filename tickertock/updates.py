@@ -0,0 +1,141 @@
+"""
+Batches button and page changes for each deck, so one keypress or
+tick - however many texts, icons and pages it touches on the way -
+reaches a deck as a single update of just the keys that changed.
+"""
+
+import time
+import functools
+
+from .metrics import METRICS
+
+MAX_FRAME_RATE = 20
+
+
+def same(have, want):
+    # KeyFrames compare by what was drawn, so a redraw of the same
+    # picture is not a change
+    return have is want or have == want
+
+
+def batched(method):
+    """
+    Make a DeckApplication method one update, however many
+    changes it (and anything it calls) makes.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.updates:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class DeckUpdates:
+    """
+    Pending changes for every deck, made through the same methods as
+    the deck server's, and pushed to it with `apply_updates` when
+    the outermost `with updates:` block ends. Reads see what is
+    pending. Each deck is updated at most `max_frame_rate` times a
+    second - anything sooner waits for a timer, then goes together.
+    """
+
+    def __init__(self, api, make_timer, max_frame_rate=MAX_FRAME_RATE):
+        self.api = api
+        self.timer = make_timer(self.flush, precise=True)
+        self.min_interval = 1 / max_frame_rate
+        self._pending = {}
+        self._applied_at = {}
+        self._depth = 0
+
+    def __enter__(self):
+        self._depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self._depth -= 1
+        if not self._depth:
+            self.flush()
+
+    def _deck(self, deck_id):
+        return self._pending.setdefault(deck_id, {"page": None, "buttons": {}})
+
+    def button(self, deck_id, page, button):
+        """
+        A button's settings as they will be once pending changes go.
+        """
+
+        settings = dict(
+            self.api.state.get(deck_id, {}).get("buttons", {}).get(page, {}).get(button, {})
+        )
+        pending = self._pending.get(deck_id)
+        if pending:
+            settings.update(pending["buttons"].get((page, button), {}))
+        return settings
+
+    def get_page(self, deck_id):
+        pending = self._pending.get(deck_id)
+        if pending and pending["page"] is not None:
+            return pending["page"]
+        return self.api.get_page(deck_id)
+
+    def get_button_text(self, deck_id, page, button):
+        return self.button(deck_id, page, button).get("text", "")
+
+    def set_page(self, deck_id, page):
+        self._deck(deck_id)["page"] = page
+
+    def set_button_text(self, deck_id, page, button, text):
+        self._deck(deck_id)["buttons"].setdefault((page, button), {})["text"] = text
+
+    def set_button_icon(self, deck_id, page, button, icon):
+        self._deck(deck_id)["buttons"].setdefault((page, button), {})["icon"] = icon
+
+    def _changes(self, deck_id, pending):
+        """
+        Drop whatever the deck is already showing.
+        """
+
+        page = pending["page"]
+        if page is not None and page == self.api.get_page(deck_id):
+            page = None
+
+        buttons = {}
+        current = self.api.state.get(deck_id, {}).get("buttons", {})
+        for (button_page, button), wanted in pending["buttons"].items():
+            have = current.get(button_page, {}).get(button, {})
+            changed = {
+                name: value
+                for name, value in wanted.items()
+                if not same(have.get(name, ""), value)
+            }
+            if changed:
+                buttons[(button_page, button)] = changed
+        return page, buttons
+
+    def flush(self):
+        now = time.monotonic()
+        wait = 0
+        for deck_id in list(self._pending):
+            if deck_id not in self.api.decks:
+                # Unplugged in the meantime
+                del self._pending[deck_id]
+                continue
+
+            due = self._applied_at.get(deck_id, 0) + self.min_interval
+            if now < due:
+                wait = max(wait, due - now)
+                continue
+
+            page, buttons = self._changes(deck_id, self._pending.pop(deck_id))
+            if page is None and not buttons:
+                METRICS.inc("tickertock_deck_updates_total", result="unchanged")
+                continue
+            METRICS.inc("tickertock_deck_updates_total", result="applied")
+            METRICS.inc("tickertock_deck_keys_updated_total", len(buttons))
+            self.api.apply_updates(deck_id, page, buttons)
+            self._applied_at[deck_id] = now
+
+        if wait and not self.timer.isActive():
+            self.timer.start(int(wait * 1000) + 1)
@@ -1,46 +1,133 @@
 import cairo
 import PIL
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import math
 
 from .config import DECK_BUTTON_SIZE
+from .frames import KeyFrame, frame_key
+from .metrics import METRICS
 
+# Frames are kept as pixels, ~64KB each at full size, so only an
+# hour's worth - older ones are read back from disk if persisted
+CLOCK_CACHE_SIZE = 60
 
-class ClockButtonBuffer(BytesIO):
+# Bump whenever draw_colour changes what it draws
+TILE_RENDERER_VERSION = 1
+
+# Drawing and disk writes that nothing is waiting on, kept off both
+# the UI thread and the API worker
+RENDERER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tickertock-render")
+
+
+class ClockFaceCache:
     """
-    Extension for BytesIO so that hashing is unique
-    for a given draw_time image. Avoids clashes in
-    streamdeck_ui display pipeline caching.
+    Bounded LRU of drawn clockfaces, keyed by hours, minutes
+    and size, so a tick is a lookup rather than a raster.
+    Optionally backed by a directory of PNGs, so frames
+    survive restarts - written on the RENDERER thread, so a
+    tick never waits on encoding or the disk.
     """
 
-    current_time = (0, 0)
+    def __init__(self, maxsize=CLOCK_CACHE_SIZE, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def persist_to(self, directory):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.directory = directory
+
+    def _path(self, key):
+        hours, mins, size = key
+        return self.directory / f"clock-{size}-{hours}-{mins}.png"
+
+    def get(self, hours, mins, size=DECK_BUTTON_SIZE):
+        key = (hours, mins, size)
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is not None:
+                self._frames.move_to_end(key)
+                METRICS.inc("tickertock_clock_cache_total", result="hit")
+                return frame
+
+        frame = self._load(key)
+        if frame is None:
+            METRICS.inc("tickertock_clock_cache_total", result="miss")
+            frame = render_clock(hours, mins, size)
+            self._save(key, frame)
+        else:
+            METRICS.inc("tickertock_clock_cache_total", result="disk")
+
+        with self._lock:
+            self._frames[key] = frame
+            while len(self._frames) > self.maxsize:
+                self._frames.popitem(last=False)
+        return frame
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            return KeyFrame(("clock",) + key, png=self._path(key).read_bytes())
+        except OSError:
+            return None
+
+    def _save(self, key, frame):
+        if self.directory is not None:
+            RENDERER.submit(self._write, key, frame)
+
+    def _write(self, key, frame):
+        try:
+            self._path(key).write_bytes(frame.getvalue())
+        except OSError as e:
+            logging.warning(f"Could not cache clockface: {e}")
+
+    def warm(self, hours=range(1), size=DECK_BUTTON_SIZE):
+        for hour in hours:
+            for mins in range(60):
+                self.get(hour, mins, size)
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
 
-    def set_current_time(self, hours, mins):
-        self.current_time = (hours, mins)
 
-    def __hash__(self):
-        return hash(self.current_time)
+CLOCK_FACES = ClockFaceCache()
 
 
-def draw_time(time_secs):
+def draw_time(time_secs, size=DECK_BUTTON_SIZE):
     """
     Draws a clockface representing minutes overlaid
     with a number representing hours.
     """
 
-    image_buffer = ClockButtonBuffer()
-    surface = cairo.ImageSurface(
-        cairo.FORMAT_ARGB32, DECK_BUTTON_SIZE, DECK_BUTTON_SIZE
-    )
+    hours = int(time_secs // 3600)
+    mins = int(time_secs // 60 % 60)
+    return CLOCK_FACES.get(hours, mins, size)
+
+
+@METRICS.timed("tickertock_render_seconds", kind="clock")
+def render_clock(hours, mins, size=DECK_BUTTON_SIZE):
+    """
+    Rasterizes a clockface.
+    """
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
     cr = cairo.Context(surface)
     cr.set_source_rgba(1, 1, 1)
-    cr.move_to(DECK_BUTTON_SIZE / 2, DECK_BUTTON_SIZE / 2)
-    arc = 2 * math.pi * (time_secs // 60 % 60) / 60
-    hours = int(time_secs // 3600)
+    cr.move_to(size / 2, size / 2)
+    arc = 2 * math.pi * mins / 60
     cr.arc(
-        DECK_BUTTON_SIZE / 2,
-        DECK_BUTTON_SIZE / 2,
-        DECK_BUTTON_SIZE / 3,
+        size / 2,
+        size / 2,
+        size / 3,
         -math.pi / 2,
         -math.pi / 2 + arc,
     )
@@ -50,37 +137,33 @@ def draw_time(time_secs):
     if hours > 0:
         cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
 
-        cr.set_font_size(50.0)
+        cr.set_font_size(50.0 * size / DECK_BUTTON_SIZE)
         xb, yb, w, h, dx, dy = cr.text_extents(str(hours))
-        x = DECK_BUTTON_SIZE / 2 - (w / 2 + xb)
-        y = DECK_BUTTON_SIZE / 2 - (h / 2 + yb)
+        x = size / 2 - (w / 2 + xb)
+        y = size / 2 - (h / 2 + yb)
 
         cr.move_to(x, y)
         cr.set_source_rgba(0.5, 0.5, 0.5)
         cr.show_text(str(hours))
 
-    image_buffer.seek(0)
-    surface.write_to_png(image_buffer)
-    image_buffer.set_current_time(hours, time_secs // 60 % 60)
-    return image_buffer
+    return KeyFrame.from_surface(("clock", hours, mins, size), surface)
 
 
-def draw_colour(code, colour):
-    surface = cairo.ImageSurface(
-        cairo.FORMAT_ARGB32, DECK_BUTTON_SIZE, DECK_BUTTON_SIZE
-    )
+@METRICS.timed("tickertock_render_seconds", kind="tile")
+def draw_colour(code, colour, size=DECK_BUTTON_SIZE):
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
     cr = cairo.Context(surface)
     rgba = [x / 255 for x in PIL.ImageColor.getcolor("#" + colour, "RGB")] + [1]
     cr.set_source_rgba(*rgba)
-    cr.rectangle(0, 0, DECK_BUTTON_SIZE, DECK_BUTTON_SIZE)
+    cr.rectangle(0, 0, size, size)
     cr.fill()
 
     cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
 
-    cr.set_font_size(80.0)
+    cr.set_font_size(80.0 * size / DECK_BUTTON_SIZE)
     xb, yb, w, h, dx, dy = cr.text_extents(code[0])
-    x = DECK_BUTTON_SIZE / 2 - (w / 2 + xb)
-    y = 0.9 * DECK_BUTTON_SIZE / 2 - (h / 2 + yb)
+    x = size / 2 - (w / 2 + xb)
+    y = 0.9 * size / 2 - (h / 2 + yb)
 
     cr.move_to(x, y)
     if min(rgba[:2]) > 0.5:
@@ -89,6 +172,97 @@ def draw_colour(code, colour):
         cr.set_source_rgba(1, 1, 1)
     cr.show_text(code[0])
 
-    image_file = BytesIO()
-    surface.write_to_png(image_file)
-    return image_file
+    return KeyFrame.from_surface(("tile", tile_hash(code, colour, size)), surface)
+
+
+@METRICS.timed("tickertock_render_seconds", kind="caption")
+def draw_caption(image, caption, size=DECK_BUTTON_SIZE):
+    """
+    Overlays a caption along the bottom of a button image,
+    given as a PNG path or KeyFrame.
+    """
+
+    base = _source_surface(image)
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+    cr = cairo.Context(surface)
+    cr.scale(size / base.get_width(), size / base.get_height())
+    cr.set_source_surface(base, 0, 0)
+    cr.paint()
+    cr.identity_matrix()
+
+    strip = size / 4
+    cr.set_source_rgba(0, 0, 0, 0.6)
+    cr.rectangle(0, size - strip, size, strip)
+    cr.fill()
+
+    cr.select_font_face("Sans", cairo.FONT_SLANT_NORMAL, cairo.FONT_WEIGHT_BOLD)
+    cr.set_font_size(strip * 0.75)
+    xb, yb, w, h, dx, dy = cr.text_extents(caption)
+    cr.move_to(size / 2 - (w / 2 + xb), size - strip / 2 - (h / 2 + yb))
+    cr.set_source_rgba(1, 1, 1)
+    cr.show_text(caption)
+
+    return KeyFrame.from_surface(("caption", frame_key(image), caption, size), surface)
+
+
+def _source_surface(image):
+    if not isinstance(image, str):
+        data = image.cairo_data()
+        if data is not None:
+            # Straight from the pixels, rather than through a PNG
+            width, height = image.size
+            return cairo.ImageSurface.create_for_data(
+                data, cairo.FORMAT_ARGB32, width, height, width * 4
+            )
+        image = BytesIO(image.getvalue())
+    return cairo.ImageSurface.create_from_png(image)
+
+
+def tile_hash(code, colour, size=DECK_BUTTON_SIZE):
+    """
+    Content hash for a colour tile - anything that changes the
+    rendered image, including the renderer itself, changes this.
+    """
+
+    key = f"{TILE_RENDERER_VERSION}:{size}:{colour.lower()}:{code[0]}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _cache_tile(path, frame):
+    try:
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(frame.getvalue())
+        os.replace(tmp, path)
+    except OSError as e:
+        logging.warning(f"Could not cache tile {path.name}: {e}")
+
+
+def draw_colours(tiles, cache_dir=None, size=DECK_BUTTON_SIZE):
+    """
+    Draws colour tiles for a map of code -> colour, reusing any
+    already cached in cache_dir and rendering the rest. New tiles
+    are written to cache_dir on the RENDERER thread.
+    """
+
+    def tile_path(code, colour):
+        return cache_dir / f"{tile_hash(code, colour, size)}.png"
+
+    images = {}
+    misses = []
+    for code, colour in tiles.items():
+        if cache_dir and tile_path(code, colour).exists():
+            images[code] = KeyFrame(
+                ("tile", tile_hash(code, colour, size)),
+                png=tile_path(code, colour).read_bytes(),
+            )
+        else:
+            misses.append((code, colour))
+
+    if cache_dir and misses:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+    for code, colour in misses:
+        images[code] = draw_colour(code, colour, size)
+        if cache_dir:
+            RENDERER.submit(_cache_tile, tile_path(code, colour), images[code])
+
+    return images
@@ -0,0 +1,92 @@
+"""
+Watches the config directory so edits to projects.toml or
+config.toml apply without a restart. Uses inotify, if
+inotify_simple is installed, and polls otherwise.
+"""
+
+import logging
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+POLL_INTERVAL = 1.0
+# Editors often write a file in several steps, so let them finish
+SETTLE_TIME = 0.3
+
+
+class ConfigWatcher(threading.Thread):
+    """
+    Calls `on_change(name)` from its own thread whenever one of
+    the named files in `directory` is written or replaced.
+    """
+
+    def __init__(self, directory, names, on_change, interval=POLL_INTERVAL):
+        super().__init__(name="tickertock-watcher", daemon=True)
+        self.directory = directory
+        self.names = set(names)
+        self.on_change = on_change
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def run(self):
+        if INotify is not None:
+            try:
+                self._run_inotify()
+                return
+            except OSError as e:
+                logging.warning(f"Could not use inotify, polling instead: {e}")
+        self._run_polling()
+
+    def _notify(self, names):
+        for name in sorted(names):
+            try:
+                self.on_change(name)
+            except Exception as e:
+                logging.error(f"Could not reload {name}: {e}")
+
+    def _run_inotify(self):
+        with INotify() as inotify:
+            # Watch the directory, not the files, as editors tend to
+            # save by writing a new file and renaming it over the old
+            inotify.add_watch(
+                str(self.directory),
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE,
+            )
+            while not self._stopping.is_set():
+                events = inotify.read(timeout=int(self.interval * 1000))
+                changed = {event.name for event in events if event.name in self.names}
+                if not changed:
+                    continue
+                changed |= {
+                    event.name
+                    for event in inotify.read(timeout=int(SETTLE_TIME * 1000))
+                    if event.name in self.names
+                }
+                self._notify(changed)
+
+    def _stat(self, name):
+        try:
+            stat = (self.directory / name).stat()
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _run_polling(self):
+        seen = {name: self._stat(name) for name in self.names}
+        while not self._stopping.wait(self.interval):
+            current = {name: self._stat(name) for name in self.names}
+            changed = {
+                name
+                for name in self.names
+                if current[name] != seen[name] and current[name] is not None
+            }
+            seen = current
+            if changed:
+                self._notify(changed)
+
+    def stop(self):
+        self._stopping.set()
+        self.join(self.interval + SETTLE_TIME + 1)
@@ -0,0 +1,99 @@
+"""
+Optional local receiver for Clockify webhooks, so changes made in
+the browser or on a phone reach the deck as they happen, instead
+of at the next poll. Clockify has to be able to reach it, so it
+usually sits behind a reverse proxy or tunnel.
+"""
+
+import hmac
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .metrics import METRICS
+
+EVENT_HEADER = "Clockify-Webhook-Event-Type"
+SIGNATURE_HEADER = "Clockify-Signature"
+MAX_BODY = 1024 * 1024
+
+
+class WebhookReceiver:
+    """
+    Accepts webhook POSTs on a background thread and calls
+    `on_event(event_type, payload)` for each one signed with one of
+    `tokens` - Clockify gives every webhook its own signing token.
+    """
+
+    def __init__(self, on_event, port, host="127.0.0.1", tokens=()):
+        self.on_event = on_event
+        self.port = port
+        self.host = host
+        self.tokens = [token.encode("utf-8") for token in tokens]
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def _signed(self, signature):
+        signature = (signature or "").encode("utf-8")
+        return any(hmac.compare_digest(signature, token) for token in self.tokens)
+
+    def start(self):
+        if not self.tokens:
+            logging.error("Not receiving webhooks, as no webhookTokens are set")
+            return False
+
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, result):
+                METRICS.inc("tickertock_webhooks_total", result=result)
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_POST(self):
+                if not receiver._signed(self.headers.get(SIGNATURE_HEADER)):
+                    return self._reply(401, "unsigned")
+
+                length = int(self.headers.get("Content-Length") or 0)
+                if length > MAX_BODY:
+                    return self._reply(413, "too_large")
+                try:
+                    payload = json.loads(self.rfile.read(length))
+                except ValueError:
+                    return self._reply(400, "invalid")
+                event = self.headers.get(EVENT_HEADER)
+                if not event or not isinstance(payload, dict):
+                    return self._reply(400, "invalid")
+
+                try:
+                    receiver.on_event(event, payload)
+                except Exception as e:
+                    logging.error(f"Could not handle {event} webhook: {e}")
+                    return self._reply(500, "error")
+                self._reply(200, "ok")
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logging.error(f"Could not receive webhooks: {e}")
+            return False
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, name="tickertock-webhooks", daemon=True
+        ).start()
+        logging.info(f"Receiving Clockify webhooks on {self.url}")
+        return True
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
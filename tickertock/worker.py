@@ -0,0 +1,79 @@
+"""
+Background worker for tocker calls, so network I/O never runs on
+the Qt thread. Commands are run one at a time, in the order they
+were submitted, so a sync can never overtake a toggle.
+"""
+
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+
+from .metrics import METRICS
+
+Command = namedtuple("Command", ["name", "function", "args", "context"])
+
+
+class TockerWorker(threading.Thread):
+    """
+    Takes commands from a queue and runs them on a daemon thread,
+    handing each outcome to `on_result(command, result, error)`.
+
+    The callback is called from the worker thread - anything that
+    touches Qt must marshal it back to the UI thread itself.
+    """
+
+    def __init__(self, on_result):
+        super().__init__(name="tickertock-worker", daemon=True)
+        self.on_result = on_result
+        self.commands = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def submit(self, name, function, *args, context=None, coalesce=False):
+        """
+        Queue a command. If `coalesce` is set, it is dropped when
+        a command with the same name is already waiting.
+        """
+
+        if coalesce:
+            with self._lock:
+                if name in self._pending:
+                    return False
+                self._pending.add(name)
+        self.commands.put(Command(name, function, args, context))
+        return True
+
+    def run(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+
+            with self._lock:
+                self._pending.discard(command.name)
+
+            start = time.perf_counter()
+            try:
+                result = command.function(*command.args)
+            except Exception as e:
+                logging.error(f"{command.name} failed: {e}")
+                result, error = None, e
+            else:
+                error = None
+            METRICS.observe(
+                "tickertock_worker_command_seconds",
+                time.perf_counter() - start,
+                command=command.name,
+                outcome="error" if error else "ok",
+            )
+
+            try:
+                self.on_result(command, result, error)
+            except Exception as e:
+                logging.error(f"Could not handle result of {command.name}: {e}")
+
+    def stop(self, timeout=5):
+        self.commands.put(None)
+        self.join(timeout)